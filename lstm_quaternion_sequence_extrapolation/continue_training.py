@@ -7,7 +7,8 @@ from torch.utils.data import DataLoader, random_split
 from torch.utils.tensorboard import SummaryWriter
 
 import recurrent_models as rm
-from dataset_initializer import RotationDataset
+from dataset_initializer import RotationDataset, IndexBatchLoader
+from dataset_shards import ShardedRotationDataset
 from utilities import *
 
 
@@ -27,6 +28,7 @@ def continue_training(
         model_type = ModelType.LSTM,
         is_qal_loss = True, 
         show_evaluation = False, 
+        index_batching = True,
 
         model_dir = rf"./models",
         set_name = "hip",
@@ -68,7 +70,11 @@ def continue_training(
     
     # 1. Creating dataset
     print("\n1. Creating dataset")
-    dataset = RotationDataset(training_path, labels_path, input_size, sequence_length)
+    if os.path.isdir(training_path):
+        # Sharded binary set written by dataset_shards.convert_to_shards
+        dataset = ShardedRotationDataset(training_path, sequence_length)
+    else:
+        dataset = RotationDataset(training_path, labels_path, input_size, sequence_length)
 
 
     # 2. Splitting dataset
@@ -80,8 +86,12 @@ def continue_training(
 
     # 3. Generating DataLoaders
     print("3. Generating DataLoaders")
-    train_loader = DataLoader(dataset=training_dataset, batch_size=batch_size)
-    test_loader = DataLoader(dataset=test_dataset, batch_size=batch_size)
+    if index_batching:
+        train_loader = IndexBatchLoader(training_dataset, batch_size=batch_size)
+        test_loader = IndexBatchLoader(test_dataset, batch_size=batch_size)
+    else:
+        train_loader = DataLoader(dataset=training_dataset, batch_size=batch_size)
+        test_loader = DataLoader(dataset=test_dataset, batch_size=batch_size)
 
 
     # 4. Creating model
@@ -150,6 +160,9 @@ def continue_training(
 
     model.train()
     for epoch in range(num_epochs - previous_epochs):
+        # Streaming datasets reseed their shuffle from the epoch
+        if hasattr(getattr(train_loader, 'dataset', None), 'set_epoch'):
+            train_loader.dataset.set_epoch(previous_epochs + epoch)
         for i, (rotations, labels) in enumerate(train_loader):
             rotations = rotations.to(device)
             labels = labels.to(device)
@@ -272,5 +285,6 @@ if __name__ == "__main__":
     execute_continue_training(ModelType.LSTM, True)             # LSTM QAL
     execute_continue_training(ModelType.QLSTM, False)           # QLSTM MSE
     execute_continue_training(ModelType.QLSTM, True)            # QLSTM QAL
+    # VectorizedQLSTM checkpoints are written by training.py or rm.convert_qlstm_checkpoint, none ship in models/
     # execute_continue_training(ModelType.VectorizedQLSTM, False)  # Vectorized QLSTM MSE
-    # execute_continue_training(ModelType.VectorizedQLSTM, True)   # Vectorized QLSTM MSE
\ No newline at end of file
+    # execute_continue_training(ModelType.VectorizedQLSTM, True)   # Vectorized QLSTM QAL
\ No newline at end of file
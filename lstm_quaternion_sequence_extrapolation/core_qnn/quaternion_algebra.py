@@ -0,0 +1,79 @@
+##########################################################
+# Quaternion algebra on tensors of shape (..., 4)
+# Components are stored last, real part first: (w, i, j, k)
+##########################################################
+
+import torch
+
+CONJUGATE_SIGNS = torch.tensor([1.0, -1.0, -1.0, -1.0])
+
+
+def multiply(q1: torch.Tensor, q2: torch.Tensor) -> torch.Tensor:
+    """
+    Hamilton product q1 * q2, broadcasting over the leading dimensions. The component
+    terms are combined elementwise and stacked once, no (..., 4, 4) temporaries.
+    """
+    w1, x1, y1, z1 = q1.unbind(-1)
+    w2, x2, y2, z2 = q2.unbind(-1)
+    return torch.stack([w1*w2 - x1*x2 - y1*y2 - z1*z2,
+                        w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                        w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                        w1*z2 + x1*y2 - y1*x2 + z1*w2], dim=-1)
+
+
+def conjugate(q: torch.Tensor) -> torch.Tensor:
+    return q * CONJUGATE_SIGNS.to(device=q.device, dtype=q.dtype)
+
+
+def normalize(q: torch.Tensor, dim: int = -1, eps: float = 0.0) -> torch.Tensor:
+    # Unit quaternions, eps is added to the squared norm
+    return q * torch.rsqrt(torch.sum(q * q, dim=dim, keepdim=True) + eps)
+
+
+def exp(q: torch.Tensor, dim: int = -1) -> torch.Tensor:
+    # exp(w + v) = e^w (cos|v| + v sin|v| / |v|), sinc keeps |v| = 0 exact and differentiable
+    w, v = q.narrow(dim, 0, 1), q.narrow(dim, 1, 3)
+    # sqrt of the squared norm, vector_norm is slow off the last axis; where keeps the gradient at |v| = 0 finite
+    squared = torch.sum(v * v, dim=dim, keepdim=True)
+    nonzero = squared > 0
+    angle = torch.where(nonzero, torch.sqrt(torch.where(nonzero, squared, 1.0)), 0.0)
+    scale = torch.exp(w)
+    return torch.cat([scale * torch.cos(angle), v * (scale * torch.sinc(angle / torch.pi))], dim=dim)
+
+
+def log(q: torch.Tensor, eps: float = 1e-12) -> torch.Tensor:
+    """
+    log(q) = log|q| + v atan2(|v|, w) / |v| for nonzero q. For |v| -> 0 the pure part
+    tends to v / w only while w > 0, that limit is used below eps. A negative real q
+    has no defined axis, its pure part keeps the direction of v with length pi.
+    """
+    w, v = q[..., :1], q[..., 1:]
+    v_norm = torch.linalg.vector_norm(v, dim=-1, keepdim=True)
+    series = (v_norm <= eps) & (w > 0)
+    # Placeholders keep the unused branch of every where finite, so no NaN reaches the gradient
+    safe_w = torch.where(series, w, 1.0)
+    safe_v_norm = torch.where(v_norm > 0, v_norm, 1.0)
+    scale = torch.where(series, 1.0 / safe_w, torch.atan2(safe_v_norm, w) / safe_v_norm)
+    return torch.cat([torch.log(torch.linalg.vector_norm(q, dim=-1, keepdim=True)), v * scale], dim=-1)
+
+
+def geodesic_angle(q1: torch.Tensor, q2: torch.Tensor) -> torch.Tensor:
+    """
+    Rotation angle (radians) between the rotations of unit quaternions q1 and q2,
+    invariant to the sign of either quaternion. Computed from the chord to the closer
+    of q2 and -q2, which stays accurate for small angles where acos(<q1, q2>) does not.
+    """
+    distance = torch.minimum(torch.linalg.vector_norm(q1 - q2, dim=-1), torch.linalg.vector_norm(q1 + q2, dim=-1))
+    return 4 * torch.asin(torch.clamp(distance / 2, max=1.0))
+
+
+def to_components(q: torch.Tensor, dim: int = -1) -> torch.Tensor:
+    # core_qnn layout, r/i/j/k blocks of n along dim, as a view with n in place of dim and the components last
+    dim = dim % q.dim()
+    return q.unflatten(dim, (4, -1)).movedim(dim, -1)
+
+
+def from_components(q: torch.Tensor, dim: int = -1) -> torch.Tensor:
+    # Inverse of to_components, the components are moved back into r/i/j/k blocks along dim
+    dim = dim % (q.dim() - 1)
+    return q.movedim(-1, dim).flatten(dim, dim + 1)
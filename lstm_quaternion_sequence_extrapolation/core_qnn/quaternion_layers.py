@@ -236,6 +236,13 @@ class QuaternionLinearAutograd(Module):
         else:
             return quaternion_linear(input, self.r_weight, self.i_weight, self.j_weight, self.k_weight, self.bias)
 
+    def expanded_weight(self):
+        # Hamilton matrix of the layer, build it once when applying the layer many times
+        if self.rotation:
+            return quaternion_rotation_kernel(self.zero_kernel, self.r_weight, self.i_weight, self.j_weight, self.k_weight,
+                                              self.quaternion_format, self.scale_param)
+        return quaternion_linear_kernel(self.r_weight, self.i_weight, self.j_weight, self.k_weight)
+
     def __repr__(self):
         return self.__class__.__name__ + '(' \
             + 'in_features=' + str(self.in_features) \
@@ -283,17 +290,11 @@ class QuaternionLinear(Module):
 
     def forward(self, input):
         # See the autograd section for explanation of what happens here.
-        if input.dim() == 3:
-            T, N, C = input.size()
-            input  = input.view(T * N, C)
-            output = QuaternionLinearFunction.apply(input, self.r_weight, self.i_weight, self.j_weight, self.k_weight, self.bias)
-            output = output.view(T, N, output.size(1))
-        elif input.dim() == 2:
-            output = QuaternionLinearFunction.apply(input, self.r_weight, self.i_weight, self.j_weight, self.k_weight, self.bias)
-        else:
+        if input.dim() not in (2, 3):
             raise NotImplementedError
 
-        return output
+        # (T, N, C) inputs go through the custom autograd function as they are
+        return quaternion_linear_function(input, self.r_weight, self.i_weight, self.j_weight, self.k_weight, self.bias)
 
     def __repr__(self):
         return self.__class__.__name__ + '(' \
@@ -15,21 +15,17 @@ from numpy.random import RandomState
 import sys
 import pdb
 from scipy.stats import chi
+from . import quaternion_algebra as qa
 
 def q_normalize(input, channel=1):
+    # channel holds the r/i/j/k blocks
+    components = input.unflatten(channel, (4, -1))
+    return qa.normalize(components, dim=channel, eps=0.0001).flatten(channel, channel + 1)
 
-    r = get_r(input)
-    i = get_i(input)
-    j = get_j(input)
-    k = get_k(input)
 
-    norm = torch.sqrt(r*r + i*i + j*j + k*k + 0.0001)
-    r = r / norm
-    i = i / norm
-    j = j / norm
-    k = k / norm
-
-    return torch.cat([r,i,j,k], dim=channel)
+def get_channel(input):
+    # Axis of the r/i/j/k blocks, the last one for linear inputs and 1 for conv inputs, as in get_r
+    return -1 if input.dim() < 4 else 1
 
 
 def check_input(input):
@@ -130,23 +126,10 @@ def get_normalized(input, eps=0.0001):
 
 
 def quaternion_exp(input):
-
-    r      = get_r(input)
-    i      = get_i(input)
-    j      = get_j(input)
-    k      = get_k(input)
-
-
-    norm_v = torch.sqrt(i*i+j*j+k*k) + 0.0001
-    exp    = torch.exp(r)
-
-    r      = torch.cos(norm_v)
-    i      = (i / norm_v) * torch.sin(norm_v)
-    j      = (j / norm_v) * torch.sin(norm_v)
-    k      = (k / norm_v) * torch.sin(norm_v)
-
-
-    return torch.cat([exp*r, exp*i, exp*j, exp*k], dim=1)
+    check_input(input)
+    # Components stay on the block axis, moving them last would make every op strided
+    channel = get_channel(input) % input.dim()
+    return qa.exp(input.unflatten(channel, (4, -1)), dim=channel).flatten(channel, channel + 1)
 
 
 def quaternion_conv(input, r_weight, i_weight, j_weight, k_weight, bias, stride,
@@ -354,6 +337,32 @@ def quaternion_transpose_conv_rotation(input, zero_kernel, r_weight, i_weight, j
     return convfunc(input, cat_kernels_4_quaternion, bias, stride, padding, output_padding, groups, dilatation)
 
 
+def quaternion_linear_kernel(r_weight, i_weight, j_weight, k_weight):
+    """
+    Builds the real (4 * in, 4 * out) matrix of a quaternion linear layer, so that
+    torch.mm(Input, kernel) is the Hamilton product W * Inputs. Gradients flow
+    back to r/i/j/k, the kernel can be built once and reused for many products.
+    """
+
+    cat_kernels_4_r = torch.cat([r_weight, -i_weight, -j_weight, -k_weight], dim=0)
+    cat_kernels_4_i = torch.cat([i_weight,  r_weight, -k_weight, j_weight], dim=0)
+    cat_kernels_4_j = torch.cat([j_weight,  k_weight, r_weight, -i_weight], dim=0)
+    cat_kernels_4_k = torch.cat([k_weight,  -j_weight, i_weight, r_weight], dim=0)
+    return torch.cat([cat_kernels_4_r, cat_kernels_4_i, cat_kernels_4_j, cat_kernels_4_k], dim=1)
+
+
+def quaternion_linear_function(input, r_weight, i_weight, j_weight, k_weight, bias=None):
+    """
+    Applies QuaternionLinearFunction, the low-memory custom autograd path. While
+    torch.compile traces the model the custom function blocks graph capture, so the
+    equivalent quaternion_linear (plain autograd, same result) is traced instead.
+    """
+
+    if torch.compiler.is_compiling():
+        return quaternion_linear(input, r_weight, i_weight, j_weight, k_weight, bias)
+    return QuaternionLinearFunction.apply(input, r_weight, i_weight, j_weight, k_weight, bias)
+
+
 def quaternion_linear(input, r_weight, i_weight, j_weight, k_weight, bias=True):
     """
     Applies a quaternion linear transformation to the incoming data:
@@ -365,11 +374,7 @@ def quaternion_linear(input, r_weight, i_weight, j_weight, k_weight, bias=True):
 
     """
 
-    cat_kernels_4_r = torch.cat([r_weight, -i_weight, -j_weight, -k_weight], dim=0)
-    cat_kernels_4_i = torch.cat([i_weight,  r_weight, -k_weight, j_weight], dim=0)
-    cat_kernels_4_j = torch.cat([j_weight,  k_weight, r_weight, -i_weight], dim=0)
-    cat_kernels_4_k = torch.cat([k_weight,  -j_weight, i_weight, r_weight], dim=0)
-    cat_kernels_4_quaternion   = torch.cat([cat_kernels_4_r, cat_kernels_4_i, cat_kernels_4_j, cat_kernels_4_k], dim=1)
+    cat_kernels_4_quaternion = quaternion_linear_kernel(r_weight, i_weight, j_weight, k_weight)
 
     if input.dim() == 2 :
 
@@ -385,18 +390,12 @@ def quaternion_linear(input, r_weight, i_weight, j_weight, k_weight, bias=True):
             return output
 
 
-def quaternion_linear_rotation(input, zero_kernel, r_weight, i_weight, j_weight, k_weight, bias=None,
+def quaternion_rotation_kernel(zero_kernel, r_weight, i_weight, j_weight, k_weight,
                                quaternion_format=False, scale=None):
     """
-    Applies a quaternion rotation transformation to the incoming data:
-
-    The rotation W*x*W^t can be replaced by R*x following:
-    https://en.wikipedia.org/wiki/Quaternions_and_spatial_rotation
-
-    Works for unitary and non unitary weights.
-
-    The initial size of the input must be a multiple of 3 if quaternion_format = False and
-    4 if quaternion_format = True.
+    Builds the real rotation matrix R of quaternion_linear_rotation, so that
+    torch.mm(Input, R) is the rotation W*x*W^t. (3 * in, 3 * out), or (4 * in, 4 * out)
+    with a zero real part when quaternion_format = True.
     """
 
     square_r          = (r_weight*r_weight)
@@ -451,6 +450,25 @@ def quaternion_linear_rotation(input, zero_kernel, r_weight, i_weight, j_weight,
 
         global_rot_kernel = torch.cat([rot_kernel_1, rot_kernel_2, rot_kernel_3], dim=1)
 
+    return global_rot_kernel
+
+
+def quaternion_linear_rotation(input, zero_kernel, r_weight, i_weight, j_weight, k_weight, bias=None,
+                               quaternion_format=False, scale=None):
+    """
+    Applies a quaternion rotation transformation to the incoming data:
+
+    The rotation W*x*W^t can be replaced by R*x following:
+    https://en.wikipedia.org/wiki/Quaternions_and_spatial_rotation
+
+    Works for unitary and non unitary weights.
+
+    The initial size of the input must be a multiple of 3 if quaternion_format = False and
+    4 if quaternion_format = True.
+    """
+
+    global_rot_kernel = quaternion_rotation_kernel(zero_kernel, r_weight, i_weight, j_weight, k_weight,
+                                                   quaternion_format, scale)
 
     if input.dim() == 2 :
         if bias is not None:
@@ -473,11 +491,7 @@ class QuaternionLinearFunction(torch.autograd.Function):
     def forward(ctx, input, r_weight, i_weight, j_weight, k_weight, bias=None):
         ctx.save_for_backward(input, r_weight, i_weight, j_weight, k_weight, bias)
         check_input(input)
-        cat_kernels_4_r = torch.cat([r_weight, -i_weight, -j_weight, -k_weight], dim=0)
-        cat_kernels_4_i = torch.cat([i_weight,  r_weight, -k_weight, j_weight], dim=0)
-        cat_kernels_4_j = torch.cat([j_weight,  k_weight, r_weight, -i_weight], dim=0)
-        cat_kernels_4_k = torch.cat([k_weight,  -j_weight, i_weight, r_weight], dim=0)
-        cat_kernels_4_quaternion = torch.cat([cat_kernels_4_r, cat_kernels_4_i, cat_kernels_4_j, cat_kernels_4_k], dim=1)
+        cat_kernels_4_quaternion = quaternion_linear_kernel(r_weight, i_weight, j_weight, k_weight)
         if input.dim() == 2 :
             if bias is not None:
                 return torch.addmm(bias, input, cat_kernels_4_quaternion)
@@ -497,44 +511,25 @@ class QuaternionLinearFunction(torch.autograd.Function):
         input, r_weight, i_weight, j_weight, k_weight, bias = ctx.saved_tensors
         grad_input = grad_weight_r = grad_weight_i = grad_weight_j = grad_weight_k = grad_bias = None
 
-        input_r = torch.cat([r_weight, -i_weight, -j_weight, -k_weight], dim=0)
-        input_i = torch.cat([i_weight,  r_weight, -k_weight, j_weight], dim=0)
-        input_j = torch.cat([j_weight,  k_weight, r_weight, -i_weight], dim=0)
-        input_k = torch.cat([k_weight,  -j_weight, i_weight, r_weight], dim=0)
-        cat_kernels_4_quaternion_T = Variable(torch.cat([input_r, input_i, input_j, input_k], dim=1).permute(1,0), requires_grad=False)
-
-        r = get_r(input)
-        i = get_i(input)
-        j = get_j(input)
-        k = get_k(input)
-        input_r = torch.cat([r, -i, -j, -k], dim=0)
-        input_i = torch.cat([i,  r, -k, j], dim=0)
-        input_j = torch.cat([j,  k, r, -i], dim=0)
-        input_k = torch.cat([k,  -j, i, r], dim=0)
-        input_mat = Variable(torch.cat([input_r, input_i, input_j, input_k], dim=1), requires_grad=False)
-
-        r = get_r(grad_output)
-        i = get_i(grad_output)
-        j = get_j(grad_output)
-        k = get_k(grad_output)
-        input_r = torch.cat([r, i, j, k], dim=1)
-        input_i = torch.cat([-i,  r, k, -j], dim=1)
-        input_j = torch.cat([-j,  -k, r, i], dim=1)
-        input_k = torch.cat([-k,  j, -i, r], dim=1)
-        grad_mat = torch.cat([input_r, input_i, input_j, input_k], dim=0)
+        # (T, N, C) inputs are handled as (T * N, C) rows, reshape only copies non-contiguous tensors
+        input_shape = input.shape
+        input = input.reshape(-1, input_shape[-1])
+        grad_output = grad_output.reshape(-1, grad_output.size(-1))
 
         if ctx.needs_input_grad[0]:
-            grad_input  = grad_output.mm(cat_kernels_4_quaternion_T)
-        if ctx.needs_input_grad[1]:
-            grad_weight = grad_mat.permute(1,0).mm(input_mat).permute(1,0)
-            unit_size_x = r_weight.size(0)
-            unit_size_y = r_weight.size(1)
-            grad_weight_r = grad_weight.narrow(0,0,unit_size_x).narrow(1,0,unit_size_y)
-            grad_weight_i = grad_weight.narrow(0,0,unit_size_x).narrow(1,unit_size_y,unit_size_y)
-            grad_weight_j = grad_weight.narrow(0,0,unit_size_x).narrow(1,unit_size_y*2,unit_size_y)
-            grad_weight_k = grad_weight.narrow(0,0,unit_size_x).narrow(1,unit_size_y*3,unit_size_y)
-        if ctx.needs_input_grad[5]:
-            grad_bias   = grad_output.sum(0).squeeze(0)
+            grad_input = grad_output.mm(quaternion_linear_kernel(r_weight, i_weight, j_weight, k_weight).t()).view(input_shape)
+        if any(ctx.needs_input_grad[1:5]):
+            # Gradient of the expanded kernel, block [a, :, b] pairs input component a
+            # with output component b. Each weight collects its four signed blocks, see
+            # quaternion_linear_kernel for where r/i/j/k appear.
+            grad_kernel = input.t().mm(grad_output).view(4, r_weight.size(0), 4, r_weight.size(1))
+            block = lambda a, b: grad_kernel[a, :, b]
+            grad_weight_r = block(0, 0) + block(1, 1) + block(2, 2) + block(3, 3)
+            grad_weight_i = block(0, 1) - block(1, 0) + block(2, 3) - block(3, 2)
+            grad_weight_j = block(0, 2) - block(1, 3) - block(2, 0) + block(3, 1)
+            grad_weight_k = block(0, 3) + block(1, 2) - block(2, 1) - block(3, 0)
+        if bias is not None and ctx.needs_input_grad[5]:
+            grad_bias   = grad_output.sum(0)
 
         return grad_input, grad_weight_r, grad_weight_i, grad_weight_j, grad_weight_k, grad_bias
 
@@ -548,33 +543,10 @@ def hamilton_product(q0, q1):
         (ry' - xz' + yr' + zx')j +
         (rz' + xy' - yx' + zr')k +
     """
-
-    q1_r = get_r(q1)
-    q1_i = get_i(q1)
-    q1_j = get_j(q1)
-    q1_k = get_k(q1)
-
-    # rr', xx', yy', and zz'
-    r_base = torch.mul(q0, q1)
-    # (rr' - xx' - yy' - zz')
-    r   = get_r(r_base) - get_i(r_base) - get_j(r_base) - get_k(r_base)
-
-    # rx', xr', yz', and zy'
-    i_base = torch.mul(q0, torch.cat([q1_i, q1_r, q1_k, q1_j], dim=1))
-    # (rx' + xr' + yz' - zy')
-    i   = get_r(i_base) + get_i(i_base) + get_j(i_base) - get_k(i_base)
-
-    # ry', xz', yr', and zx'
-    j_base = torch.mul(q0, torch.cat([q1_j, q1_k, q1_r, q1_i], dim=1))
-    # (rx' + xr' + yz' - zy')
-    j   = get_r(j_base) - get_i(j_base) + get_j(j_base) + get_k(j_base)
-
-    # rz', xy', yx', and zr'
-    k_base = torch.mul(q0, torch.cat([q1_k, q1_j, q1_i, q1_r], dim=1))
-    # (rx' + xr' + yz' - zy')
-    k   = get_r(k_base) + get_i(k_base) - get_j(k_base) + get_k(k_base)
-
-    return torch.cat([r, i, j, k], dim=1)
+    check_input(q0)
+    check_input(q1)
+    channel = get_channel(q0)
+    return qa.from_components(qa.multiply(qa.to_components(q0, channel), qa.to_components(q1, channel)), channel)
 
 #
 # PARAMETERS INITIALIZATION
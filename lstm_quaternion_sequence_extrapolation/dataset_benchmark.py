@@ -0,0 +1,154 @@
+import csv
+import time
+import shutil
+import tempfile
+import tracemalloc
+import math
+import torch
+
+from dataset_initializer import RotationDataset
+from dataset_windows import SlidingWindowDataset
+from quaternion_encoding import angular_error, angular_error_bound
+from synthetic_data import generate_synthetic_set
+from set_complexity import streaming_set_complexity
+
+
+def measure(function):
+    # Returns (result, seconds, peak traced memory in MB)
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 2**20
+
+
+def benchmark_parsing(training_path, labels_path, input_size=4, sequence_length=100):
+    print(f"\n>>> Parsing benchmark: {training_path} <<<")
+
+    legacy, legacy_time, legacy_peak = measure(
+        lambda: RotationDataset(training_path, labels_path, input_size, sequence_length, bulk_parsing=False))
+    bulk, bulk_time, bulk_peak = measure(
+        lambda: RotationDataset(training_path, labels_path, input_size, sequence_length, use_cache=False))
+
+    tensor_size = (bulk.training_data.nelement() + bulk.labels_data.nelement()) * 4 / 2**20
+    print(f"Samples: {len(bulk)}, tensor size: {tensor_size:.2f}MB")
+    print(f"Legacy loader: {legacy_time:.3f}s, peak memory: {legacy_peak:.2f}MB")
+    print(f"Bulk loader:   {bulk_time:.3f}s, peak memory: {bulk_peak:.2f}MB")
+    print(f"Speedup: {legacy_time / bulk_time:.1f}x, memory reduction: {legacy_peak / bulk_peak:.1f}x")
+
+    same = torch.equal(legacy.training_data, bulk.training_data) and torch.equal(legacy.labels_data, bulk.labels_data)
+    print(f"Identical tensors: {same}")
+
+
+def benchmark_cache(training_path, labels_path, input_size=4, sequence_length=100):
+    print(f"\n>>> Cache benchmark: {training_path} <<<")
+    cache_dir = tempfile.mkdtemp()
+    try:
+        parsed, cold_time, _ = measure(
+            lambda: RotationDataset(training_path, labels_path, input_size, sequence_length, cache_dir=cache_dir))
+        mapped, warm_time, warm_peak = measure(
+            lambda: RotationDataset(training_path, labels_path, input_size, sequence_length, cache_dir=cache_dir))
+    finally:
+        shutil.rmtree(cache_dir)
+
+    print(f"First run (parse + write cache): {cold_time * 1000:.1f}ms")
+    print(f"Cached run (memory-mapped):      {warm_time * 1000:.1f}ms, peak memory: {warm_peak:.2f}MB")
+    same = torch.equal(parsed.training_data, mapped.training_data) and torch.equal(parsed.labels_data, mapped.labels_data)
+    print(f"Identical tensors: {same}")
+
+
+def benchmark_compact_encoding(training_path, labels_path, input_size=4, sequence_length=100):
+    print(f"\n>>> Compact encoding benchmark: {training_path} <<<")
+    cache_dir = tempfile.mkdtemp()
+    try:
+        full = RotationDataset(training_path, labels_path, input_size, sequence_length, cache_dir=cache_dir)
+        compact = RotationDataset(training_path, labels_path, input_size, sequence_length, cache_dir=cache_dir, compact=True)
+        indices = torch.arange(len(full))
+        decoded, decode_time, _ = measure(lambda: compact.get_batch(indices))
+    finally:
+        shutil.rmtree(cache_dir)
+
+    full_size = full.training_data.nelement() * full.training_data.element_size()
+    compact_size = compact.training_data.nbytes()
+    errors = angular_error(decoded[0], full.training_data)
+    print(f"Float32 storage: {full_size / 2**20:.2f}MB, compact storage: {compact_size / 2**20:.2f}MB ({full_size / compact_size:.2f}x smaller)")
+    print(f"Decoding all {len(full)} samples: {decode_time * 1000:.1f}ms")
+    print(f"Angular error max: {math.degrees(errors.max().item()):.6f} deg, mean: {math.degrees(errors.mean().item()):.6f} deg")
+    print(f"Angular error bound: {math.degrees(angular_error_bound()):.6f} deg")
+
+
+def legacy_set_complexity(data:torch.tensor, label:str):
+    # In-memory reference for streaming_set_complexity, one column at a time
+    mean = torch.mean(data + 1)
+    std = torch.std(data + 1)
+    cv = (std / mean) * 100
+
+    iqr = torch.quantile(data, 0.75) - torch.quantile(data, 0.25)
+
+    hist = torch.histc(data, bins=10, min=float(data.min()), max=float(data.max()))
+    pdf = hist / torch.sum(hist)
+    entropy = -torch.sum(pdf * torch.log2(pdf + torch.finfo(torch.float32).eps))
+
+    return [label, cv.item(), iqr.item(), entropy.item()]
+
+
+def benchmark_set_complexity(file_path):
+    print(f"\n>>> Set complexity benchmark: {file_path} <<<")
+
+    def legacy():
+        with open(file_path, 'r') as file:
+            rows = list(csv.reader(file))
+        data = torch.tensor([[float(value) for value in row] for row in rows[1:]]).transpose(0, 1)
+        return [legacy_set_complexity(data[i], label) for i, label in enumerate(rows[0])]
+
+    reference, legacy_time, legacy_peak = measure(legacy)
+    streamed, streaming_time, streaming_peak = measure(lambda: streaming_set_complexity(file_path))
+
+    difference = max(abs(a - b) for expected, result in zip(reference, streamed[1:]) for a, b in zip(expected[1:], result[1:]))
+    print(f"Legacy:    {legacy_time * 1000:.1f}ms, peak memory: {legacy_peak:.2f}MB")
+    print(f"Streaming: {streaming_time * 1000:.1f}ms, peak memory: {streaming_peak:.2f}MB")
+    print(f"Max difference: {difference:.2e}")
+
+
+def benchmark_sliding_windows(sequence_length=100, stride=1, horizon=1):
+    # Track lengths include one shorter than a window and one with exactly one window
+    lengths = (2000, 50, sequence_length + horizon, 700)
+    print(f"\n>>> Sliding windows benchmark: tracks of {lengths} frames <<<")
+    torch.manual_seed(303)
+    tracks = [torch.randn(length, 4) for length in lengths]
+
+    def legacy():
+        windows, labels = [], []
+        for track in tracks:
+            for start in range(0, track.size(0) - sequence_length - horizon + 1, stride):
+                windows.append(track[start:start + sequence_length])
+                labels.append(track[start + sequence_length - 1 + horizon].unsqueeze(0))
+        return torch.stack(windows), torch.stack(labels)
+
+    (rotations, labels), legacy_time, legacy_peak = measure(legacy)
+    dataset, windows_time, windows_peak = measure(lambda: SlidingWindowDataset(tracks, sequence_length, stride, horizon))
+    batch = dataset.get_batch(torch.arange(len(dataset)))
+
+    print(f"Windows: {len(dataset)}, expected: {len(rotations)}")
+    print(f"Materialized windows: {legacy_time * 1000:.1f}ms, peak memory: {legacy_peak:.2f}MB")
+    print(f"Strided views:        {windows_time * 1000:.1f}ms, peak memory: {windows_peak:.2f}MB")
+    print(f"Identical tensors: {torch.equal(batch[0], rotations) and torch.equal(batch[1], labels)}")
+
+
+if __name__ == "__main__":
+    benchmark_parsing(r"./data/mockup/training_data (Small).csv", r"./data/mockup/labels_data (Small).csv")
+    benchmark_cache(r"./data/mockup/training_data (Small).csv", r"./data/mockup/labels_data (Small).csv")
+    benchmark_compact_encoding(r"./data/mockup/training_data (Small).csv", r"./data/mockup/labels_data (Small).csv")
+
+    # Synthetic set about 50x the Small mockup
+    synthetic_dir = tempfile.mkdtemp()
+    try:
+        training_path, labels_path = generate_synthetic_set(synthetic_dir, n_recordings=8, n_joints=3, n_frames=2200, stride=10)
+        benchmark_parsing(training_path, labels_path)
+        benchmark_cache(training_path, labels_path)
+    finally:
+        shutil.rmtree(synthetic_dir)
+    benchmark_set_complexity(r"./data/mockup/source_sets.csv")
+    benchmark_sliding_windows()
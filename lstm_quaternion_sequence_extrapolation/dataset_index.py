@@ -0,0 +1,95 @@
+import re
+import numpy as np
+
+# "Test406 - LHipAngles [w] (0,99)"
+LABEL_PATTERN = re.compile(rb'^"?(?P<recording>.*?) - (?P<joint>.*?) \[(?P<component>\w+)\] \((?P<start>\d+),(?P<end>\d+)\)"?,')
+
+
+class RowIndex:
+    """
+    Metadata of every row of a rotation CSV, parsed from the row labels.
+
+    Holds the byte offset of each row together with its recording, joint, component
+    and frame range, so subsets of a set can be located and read without parsing
+    the whole file. Names are stored once in vocabularies and referenced by codes.
+    Rows whose label does not follow the pattern keep the label as recording name.
+    """
+
+    def __init__(self, offsets, recordings, joints, components, frame_starts, frame_ends,
+                 recording_names, joint_names, component_names):
+        self.offsets =          offsets
+        self.recordings =       recordings
+        self.joints =           joints
+        self.components =       components
+        self.frame_starts =     frame_starts
+        self.frame_ends =       frame_ends
+        self.recording_names =  recording_names
+        self.joint_names =      joint_names
+        self.component_names =  component_names
+
+    @classmethod
+    def build(cls, file_path: str):
+        print(f"Indexing: {file_path}")
+        vocabularies = ({}, {}, {})
+        offsets, codes, frame_starts, frame_ends = [], [], [], []
+
+        with open(file_path, 'rb') as file:
+            offset = 0
+            for line in file:
+                match = LABEL_PATTERN.match(line)
+                if match is not None:
+                    names = match.group("recording", "joint", "component")
+                    frame_starts.append(int(match.group("start")))
+                    frame_ends.append(int(match.group("end")))
+                else:
+                    names = (line.split(b',', 1)[0].strip(b'"'), b"", b"")
+                    frame_starts.append(-1)
+                    frame_ends.append(-1)
+
+                codes.append([vocabulary.setdefault(name.decode(), len(vocabulary)) for vocabulary, name in zip(vocabularies, names)])
+                offsets.append(offset)
+                offset += len(line)
+
+        codes = np.array(codes, dtype=np.int32).reshape(-1, 3)
+        names = [np.array(list(vocabulary), dtype=str) for vocabulary in vocabularies]
+        return cls(np.array(offsets, dtype=np.int64), codes[:, 0], codes[:, 1], codes[:, 2],
+                   np.array(frame_starts, dtype=np.int64), np.array(frame_ends, dtype=np.int64), *names)
+
+    def save(self, file):
+        np.savez(file, **vars(self))
+
+    @classmethod
+    def load(cls, file_path: str):
+        with np.load(file_path) as data:
+            return cls(**{name: data[name] for name in data.files})
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def sample_rows(self, input_size=4):
+        # First row of every sample, each sample spans input_size rows
+        return np.arange(0, (len(self) // input_size) * input_size, input_size)
+
+    def select(self, input_size=4, recordings=None, joints=None, frame_range=None):
+        """
+        Sample ids whose recording and joint are listed and whose frames lie
+        within the inclusive frame_range=(first, last). None keeps everything.
+        """
+        rows = self.sample_rows(input_size)
+        mask = np.ones(len(rows), dtype=bool)
+        if recordings is not None:
+            mask &= np.isin(self.recording_names[self.recordings[rows]], list(recordings))
+        if joints is not None:
+            mask &= np.isin(self.joint_names[self.joints[rows]], list(joints))
+        if frame_range is not None:
+            mask &= (self.frame_starts[rows] >= frame_range[0]) & (self.frame_ends[rows] <= frame_range[1])
+        return np.nonzero(mask)[0]
+
+    def sample_metadata(self, sample_ids, input_size=4):
+        rows = self.sample_rows(input_size)[sample_ids]
+        return {
+            "recording":    self.recording_names[self.recordings[rows]],
+            "joint":        self.joint_names[self.joints[rows]],
+            "frame_start":  self.frame_starts[rows],
+            "frame_end":    self.frame_ends[rows]
+        }
@@ -1,28 +1,267 @@
+import os
 import csv
+import json
+import hashlib
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Subset
+
+from dataset_index import RowIndex
+from quaternion_encoding import CompactQuaternions, decode_if_compact
+
+
+def count_csv_columns(file_path: str):
+    # Number of value columns (without the leading row label)
+    with open(file_path, 'r') as file:
+        first_row = next(csv.reader(file))
+    return len(first_row) - 1
+
+
+def _rows_to_tensor(data, input_size):
+    # (samples * input_size, columns) rows -> contiguous (samples, columns, input_size)
+    n_samples = data.shape[0] // input_size
+    data = data[:n_samples * input_size].reshape(n_samples, input_size, data.shape[1])
+    return torch.from_numpy(np.ascontiguousarray(data.transpose(0, 2, 1)))
+
+
+def read_rotation_csv(file_path: str, input_size=4, num_columns=None):
+    """
+    Parses a rotation CSV straight into a contiguous float32 tensor of shape
+    (samples, num_columns, input_size).
+
+    Every sample is stored as input_size consecutive rows (w, i, j, k), each row
+    starting with a quoted label. The file is parsed by the C reader of numpy
+    in one call, so no Python object is created per value.
+    """
+    if num_columns is None:
+        num_columns = count_csv_columns(file_path)
+    return parse_rotation_rows(file_path, input_size, num_columns)
+
+
+def parse_rotation_rows(rows, input_size, num_columns):
+    # rows is either a file path or a list of CSV lines
+    data = np.loadtxt(
+        rows,
+        dtype=np.float32,
+        delimiter=',',
+        quotechar='"',
+        usecols=range(1, num_columns + 1),
+        ndmin=2
+    )
+    return _rows_to_tensor(data, input_size)
+
+
+def file_content_hash(file_path: str, chunk_size=2**24):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_atomic(path: str, write):
+    # Concurrent jobs may build the same cache, the last rename simply wins
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as file:
+        write(file)
+    os.replace(temp_path, path)
+
+
+def _cache_unavailable(file_path: str, ex: OSError):
+    # Read-only or missing data directories still load, only without the binary cache
+    print(f"Warning: cache unavailable for {file_path} ({type(ex).__name__}: {ex}), reading without cache")
+
+
+def resolve_cache_key(file_path: str, cache_dir=None):
+    """
+    Returns (cache_dir, content_hash) of a data file.
+
+    Cache entries are keyed by the file path, size and modification time, which
+    point to the content hash naming the cached arrays. A touched but unchanged
+    file is re-hashed and keeps using its cache.
+    """
+    file_path = os.path.abspath(file_path)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(file_path), ".rotation_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    stat = os.stat(file_path)
+    path_key = hashlib.blake2b(file_path.encode(), digest_size=10).hexdigest()
+    meta_path = os.path.join(cache_dir, f"{path_key}.json")
+
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as file:
+            meta = json.load(file)
+
+    if meta is not None and meta["path"] == file_path and meta["size"] == stat.st_size and meta["mtime_ns"] == stat.st_mtime_ns:
+        content_hash = meta["content_hash"]
+    else:
+        content_hash = file_content_hash(file_path)
+
+    new_meta = {"path": file_path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "content_hash": content_hash}
+    if new_meta != meta:
+        _write_atomic(meta_path, lambda file: file.write(json.dumps(new_meta).encode()))
+    return cache_dir, content_hash
+
+
+def load_cached_rotation_tensor(file_path: str, input_size=4, cache_dir=None, compact=False):
+    """
+    Returns the parsed (samples, columns, input_size) tensor of a rotation CSV,
+    memory-mapped from a binary cache.
+
+    The cache is built on first use, see resolve_cache_key for how it is keyed.
+    The array is mapped copy-on-write, so concurrent jobs share the page cache.
+    With compact=True the cache holds CompactQuaternions arrays and those are returned.
+    When the cache directory cannot be created or written, the CSV is parsed into memory.
+    """
+    if compact and input_size != 4:
+        raise ValueError(f"Compact encoding needs quaternion samples (input_size=4), got input_size={input_size}")
+
+    def read_uncached():
+        print(f"Reading: {file_path}")
+        data = read_rotation_csv(file_path, input_size)
+        return CompactQuaternions.encode(data) if compact else data
+
+    try:
+        cache_dir, content_hash = resolve_cache_key(file_path, cache_dir)
+    except OSError as ex:
+        _cache_unavailable(file_path, ex)
+        return read_uncached()
+
+    if compact:
+        data_paths = [os.path.join(cache_dir, f"{content_hash}_q{input_size}_compact_{part}.npy") for part in ("components", "selectors")]
+    else:
+        data_paths = [os.path.join(cache_dir, f"{content_hash}_q{input_size}.npy")]
+
+    if not all(os.path.exists(path) for path in data_paths):
+        data = read_uncached()
+        arrays = [data.components.numpy(), data.selectors.numpy()] if compact else [data.numpy()]
+        try:
+            for path, array in zip(data_paths, arrays):
+                _write_atomic(path, lambda file: np.save(file, array))
+        except OSError as ex:
+            _cache_unavailable(file_path, ex)
+            return data
+    else:
+        print(f"Mapping cache: {file_path}")
+
+    arrays = [torch.from_numpy(np.load(path, mmap_mode='c')) for path in data_paths]
+    return CompactQuaternions(*arrays) if compact else arrays[0]
+
+
+def load_row_index(file_path: str, cache_dir=None, use_cache=True):
+    # RowIndex of a rotation CSV, stored next to its dataset cache
+    if not use_cache:
+        return RowIndex.build(file_path)
+
+    try:
+        cache_dir, content_hash = resolve_cache_key(file_path, cache_dir)
+    except OSError as ex:
+        _cache_unavailable(file_path, ex)
+        return RowIndex.build(file_path)
+
+    index_path = os.path.join(cache_dir, f"{content_hash}_index.npz")
+    if os.path.exists(index_path):
+        return RowIndex.load(index_path)
+
+    index = RowIndex.build(file_path)
+    try:
+        _write_atomic(index_path, index.save)
+    except OSError as ex:
+        _cache_unavailable(file_path, ex)
+    return index
+
+
+def read_rotation_samples(file_path: str, row_offsets, input_size=4, num_columns=None):
+    # Parses only the samples starting at the given byte offsets
+    if num_columns is None:
+        num_columns = count_csv_columns(file_path)
+
+    rows = []
+    with open(file_path, 'rb') as file:
+        for offset in row_offsets:
+            file.seek(offset)
+            rows.extend(file.readline().decode() for _ in range(input_size))
+    return parse_rotation_rows(rows, input_size, num_columns)
+
 
 class RotationDataset(Dataset):
-    def __init__(self, training_path, labels_path, input_size, sequence_length):
+    def __init__(self, training_path, labels_path, input_size, sequence_length, bulk_parsing=True, use_cache=True, cache_dir=None,
+                 compact=False, recordings=None, joints=None, frame_range=None):
         super(RotationDataset, self).__init__()
         self.training_path = training_path
         self.labels_path = labels_path
         self.input_size = input_size
         self.sequence_length = sequence_length
+        self.use_cache = use_cache
+        self.cache_dir = cache_dir
+        self.row_index = None
+        self.sample_ids = None
+
+        # Selecting recordings, joints or frame ranges through the row label index
+        if recordings is not None or joints is not None or frame_range is not None:
+            if not bulk_parsing:
+                raise ValueError("Selecting recordings, joints or frame ranges needs bulk_parsing=True")
+            self.row_index = load_row_index(training_path, cache_dir, use_cache)
+            self.sample_ids = torch.from_numpy(self.row_index.select(input_size, recordings, joints, frame_range))
+
+        if bulk_parsing and use_cache:
+            self.training_data = load_cached_rotation_tensor(training_path, input_size, cache_dir, compact)
+            self.labels_data = load_cached_rotation_tensor(labels_path, input_size, cache_dir, compact)
+            if self.sample_ids is not None:
+                self.training_data = self.training_data[self.sample_ids]
+                self.labels_data = self.labels_data[self.sample_ids]
+            self.training_data = self.training_data[:, :sequence_length]
+            self.labels_data = self.labels_data[:, :1]
+        elif bulk_parsing and self.sample_ids is not None:
+            labels_index = load_row_index(labels_path, cache_dir, use_cache)
+            print(f"Reading {len(self.sample_ids)} samples: {training_path}")
+            self.training_data = read_rotation_samples(
+                training_path, self.row_index.offsets[self.row_index.sample_rows(input_size)[self.sample_ids]], input_size, sequence_length)
+            print(f"Reading {len(self.sample_ids)} samples: {labels_path}")
+            self.labels_data = read_rotation_samples(
+                labels_path, labels_index.offsets[labels_index.sample_rows(input_size)[self.sample_ids]], input_size, 1)
+        elif bulk_parsing:
+            print(f"Reading: {training_path}")
+            self.training_data = read_rotation_csv(training_path, input_size, sequence_length)
+            print(f"Reading: {labels_path}")
+            self.labels_data = read_rotation_csv(labels_path, input_size, 1)
+        else:
+            self.training_data = self._read_dataset(training_path)
+            self.labels_data = self._read_dataset(labels_path)
 
-        self.training_data = self._read_dataset(training_path)
-        self.labels_data = self._read_dataset(labels_path)
+            self.training_data = self._prepare_training_dataset(self.training_data, input_size, sequence_length)
+            self.labels_data = self._prepare_labels_dataset(self.labels_data, input_size)
 
-        self.training_data = self._prepare_training_dataset(self.training_data, input_size, sequence_length)
-        self.labels_data = self._prepare_labels_dataset(self.labels_data, input_size)
+        # Compact in-memory storage, decoded per batch
+        if compact and not isinstance(self.training_data, CompactQuaternions):
+            self.training_data = CompactQuaternions.encode(self.training_data)
+            self.labels_data = CompactQuaternions.encode(self.labels_data)
         self.n_samples = self.training_data.size()[0]
-    
+
+    def sample_metadata(self, indices=None):
+        """
+        Recording, joint and frame range of the given dataset samples (all by default),
+        taken from the row label index instead of re-parsing the file.
+        """
+        if self.row_index is None:
+            self.row_index = load_row_index(self.training_path, self.cache_dir, self.use_cache)
+
+        sample_ids = torch.arange(self.n_samples) if self.sample_ids is None else self.sample_ids
+        if indices is not None:
+            sample_ids = sample_ids[torch.as_tensor(indices)]
+        return self.row_index.sample_metadata(sample_ids.numpy(), self.input_size)
+
     def __getitem__(self, index):
-        return self.training_data[index], self.labels_data[index]
-    
+        return decode_if_compact(self.training_data[index]), decode_if_compact(self.labels_data[index])
+
     def __len__(self):
         return self.n_samples
 
+    def get_batch(self, indices):
+        return decode_if_compact(self.training_data[indices]), decode_if_compact(self.labels_data[indices])
+
     def _read_dataset(self, file_path: str):
         print(f"Reading: {file_path}")
         data = []
@@ -38,20 +277,148 @@ class RotationDataset(Dataset):
     def _prepare_training_dataset(self, data, input_size, sequence_length):
         final_data = []
         for i in range(int(len(data) / input_size)):
+            row = i * input_size
             sequence = []
             for j in range(sequence_length):
-                sequence.append([data[i][j], data[i+1][j], data[i+2][j], data[i+3][j]])
+                sequence.append([data[row][j], data[row+1][j], data[row+2][j], data[row+3][j]])
             final_data.append(sequence)
-        
+
         #return final_data
         return torch.tensor(final_data)
-    
+
     def _prepare_labels_dataset(self, data, input_size):
         final_data = []
         for i in range(int(len(data) / input_size)):
+            row = i * input_size
             sequence = []
-            sequence.append([data[i][0], data[i+1][0], data[i+2][0], data[i+3][0]])
+            sequence.append([data[row][0], data[row+1][0], data[row+2][0], data[row+3][0]])
             final_data.append(sequence)
-        
+
         #return final_data
-        return torch.tensor(final_data)
\ No newline at end of file
+        return torch.tensor(final_data)
+
+
+class IndexBatchLoader:
+    """
+    DataLoader replacement for in-memory datasets exposing get_batch(indices).
+
+    Whole batches are gathered from the backing tensors with one index per batch
+    instead of collating batch_size single samples. Subsets (e.g. from random_split)
+    are resolved to indices of the base dataset, and shuffling permutes those indices.
+    Without shuffling batches come in the same order as DataLoader(dataset, batch_size).
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, drop_last=False, generator=None):
+        indices = torch.arange(len(dataset))
+        while isinstance(dataset, Subset):
+            indices = torch.as_tensor(dataset.indices)[indices]
+            dataset = dataset.dataset
+
+        self.dataset =      dataset
+        self.indices =      indices
+        self.batch_size =   batch_size
+        self.shuffle =      shuffle
+        self.drop_last =    drop_last
+        self.generator =    generator
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices), generator=self.generator)]
+
+        for batch in indices.split(self.batch_size):
+            if self.drop_last and len(batch) < self.batch_size:
+                return
+            yield self.dataset.get_batch(batch)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.indices) // self.batch_size
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+
+class RecordingTrackLoader:
+    """
+    Batches of continuous recording tracks rebuilt from overlapping windows, for stateful
+    truncated-BPTT training.
+
+    Windows of the dataset (or a Subset of it) are ordered by recording, joint and first
+    frame through sample_metadata. Windows whose frames overlap or touch are merged into
+    one track holding every frame once, and each window label is placed at the window's
+    last frame. A model run over a track with its state carried forward therefore sees
+    every window once while encoding every frame once. Tracks are batched longest first
+    and padded to the longest track of the batch; every batch is (rotations (B, T, 4),
+    labels (B, T, 4), mask (B, T)), mask marking the frames that carry a window label.
+    Only the track layout is built up front, every batch reads its windows through
+    get_batch, so memory is bounded by one batch.
+    """
+
+    def __init__(self, dataset, batch_size=1):
+        indices = torch.arange(len(dataset))
+        while isinstance(dataset, Subset):
+            indices = torch.as_tensor(dataset.indices)[indices]
+            dataset = dataset.dataset
+        if not hasattr(dataset, "sample_metadata"):
+            raise TypeError(f"Stateful batching needs a dataset with sample_metadata, got {type(dataset).__name__}")
+
+        metadata = dataset.sample_metadata(indices)
+        if (metadata["frame_start"] < 0).any():
+            raise ValueError("Stateful batching needs row labels with frame ranges, e.g. \"Test406 - LHipAngles [w] (0,99)\"")
+        window_length, n_features = dataset[int(indices[0])][0].shape
+
+        # Windows ordered by recording, joint and first frame, a new track starts at every gap
+        order = np.lexsort((metadata["frame_start"], metadata["joint"], metadata["recording"]))
+        starts = metadata["frame_start"][order]
+        same_source = (metadata["recording"][order][1:] == metadata["recording"][order][:-1]) & \
+                      (metadata["joint"][order][1:] == metadata["joint"][order][:-1])
+        new_track = np.concatenate([[True], ~same_source | (starts[1:] > starts[:-1] + window_length)])
+        track_ids = np.cumsum(new_track) - 1
+
+        # First window, window count, first frame and length of every track, frame position of every window inside its track
+        track_windows = np.nonzero(new_track)[0]
+        track_starts = starts[new_track]
+        track_lengths = np.maximum.reduceat(starts, track_windows) - track_starts + window_length
+
+        # Only the layout is kept, the frames of a batch are gathered from the dataset when it is yielded
+        self.dataset =          dataset
+        self.batch_size =       batch_size
+        self.window_length =    window_length
+        self.n_features =       n_features
+        self.indices =          indices[torch.from_numpy(order)]
+        self.window_offsets =   starts - track_starts[track_ids]
+        self.track_windows =    np.append(track_windows, len(order))
+        self.track_lengths =    track_lengths
+        self.track_order =      np.argsort(-track_lengths, kind='stable')
+        self.n_tracks =         len(track_lengths)
+        self.n_windows =        len(order)
+        self.n_frames =         int(track_lengths.sum())
+
+    def _batches(self):
+        # Windows of every batch of tracks (longest first) with their track row and first frame inside the padded batch
+        for first in range(0, self.n_tracks, self.batch_size):
+            tracks = self.track_order[first:first + self.batch_size]
+            windows = np.concatenate([np.arange(self.track_windows[track], self.track_windows[track + 1]) for track in tracks])
+            rows = np.repeat(np.arange(len(tracks)), self.track_windows[tracks + 1] - self.track_windows[tracks])
+            yield windows, torch.from_numpy(rows), torch.from_numpy(self.window_offsets[windows]), len(tracks), int(self.track_lengths[tracks[0]])
+
+    def _mask(self, rows, offsets, n_tracks, length):
+        mask = torch.zeros(n_tracks, length, dtype=torch.bool)
+        mask[rows, offsets + self.window_length - 1] = True
+        return mask
+
+    def __iter__(self):
+        for windows, rows, offsets, n_tracks, length in self._batches():
+            rotations, labels = self.dataset.get_batch(self.indices[torch.from_numpy(windows)])
+            frames = torch.zeros(n_tracks, length, self.n_features)
+            frames[rows.unsqueeze(1), offsets.unsqueeze(1) + torch.arange(self.window_length)] = rotations
+            track_labels = torch.zeros_like(frames)
+            track_labels[rows, offsets + self.window_length - 1] = labels.reshape(len(windows), -1)
+            yield frames, track_labels, self._mask(rows, offsets, n_tracks, length)
+
+    def __len__(self):
+        return (self.n_tracks + self.batch_size - 1) // self.batch_size
+
+    def n_chunks(self, chunk_length):
+        # Truncated-BPTT chunks of chunk_length frames that carry at least one label, counted without reading frames
+        return sum(bool(chunk.any()) for _, rows, offsets, n_tracks, length in self._batches()
+                   for chunk in self._mask(rows, offsets, n_tracks, length).split(chunk_length, dim=1))
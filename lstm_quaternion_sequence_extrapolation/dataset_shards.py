@@ -0,0 +1,157 @@
+import os
+import json
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler, Subset
+
+from dataset_initializer import count_csv_columns
+from dataset_streaming import StreamingRotationDataset
+
+INDEX_FILE_NAME = "index.json"
+
+
+def write_shards(batches, output_dir, input_size, sequence_length, samples_per_shard):
+    """
+    Writes an iterable of (rotations, labels) batches of samples_per_shard samples
+    (the last one may be shorter) as binary shards plus an index file.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    shards = []
+    for shard_id, (rotations, labels) in enumerate(batches):
+        training_file = f"shard_{shard_id:05d}_training.npy"
+        labels_file = f"shard_{shard_id:05d}_labels.npy"
+        np.save(os.path.join(output_dir, training_file), rotations.numpy())
+        np.save(os.path.join(output_dir, labels_file), labels.numpy())
+        shards.append({"training": training_file, "labels": labels_file, "samples": rotations.size(0)})
+        print(f"Shard {shard_id} written: {rotations.size(0)} samples")
+
+    index = {
+        "input_size": input_size,
+        "sequence_length": sequence_length,
+        "samples_per_shard": samples_per_shard,
+        "n_samples": sum(shard["samples"] for shard in shards),
+        "shards": shards
+    }
+    with open(os.path.join(output_dir, INDEX_FILE_NAME), 'w') as file:
+        json.dump(index, file, indent=4)
+    return index
+
+
+def convert_to_shards(training_path, labels_path, output_dir, input_size=4, sequence_length=None, samples_per_shard=4096):
+    """
+    Converts a training/labels CSV pair into fixed-size binary shards plus an index file.
+
+    The CSVs are streamed, so the conversion itself runs in bounded memory. Every
+    shard holds samples_per_shard samples (the last one may be shorter) as
+    (samples, sequence_length, input_size) and (samples, 1, input_size) float32 .npy files.
+    """
+    if sequence_length is None:
+        sequence_length = count_csv_columns(training_path)
+
+    stream = StreamingRotationDataset(training_path, labels_path, input_size, sequence_length,
+                                      batch_size=samples_per_shard, chunk_samples=samples_per_shard)
+    return write_shards(stream, output_dir, input_size, sequence_length, samples_per_shard)
+
+
+class ShardedRotationDataset(Dataset):
+    """
+    RotationDataset-compatible view of a directory written by convert_to_shards.
+
+    Shards are memory-mapped on first access, so any sample is read in O(1)
+    without loading the set into RAM. Works with random_split, DataLoader,
+    IndexBatchLoader and ShardBlockSampler.
+    """
+
+    def __init__(self, shard_dir, sequence_length=None):
+        super(ShardedRotationDataset, self).__init__()
+        with open(os.path.join(shard_dir, INDEX_FILE_NAME), 'r') as file:
+            index = json.load(file)
+
+        self.shard_dir =            shard_dir
+        self.shards =               index["shards"]
+        self.input_size =           index["input_size"]
+        self.samples_per_shard =    index["samples_per_shard"]
+        self.n_samples =            index["n_samples"]
+        self.sequence_length =      sequence_length if sequence_length is not None else index["sequence_length"]
+        self.mapped =               {}
+
+        if self.sequence_length > index["sequence_length"]:
+            raise ValueError(f"Shards hold sequences of {index['sequence_length']} frames, requested {self.sequence_length}")
+
+    def _shard(self, shard_id):
+        # Mapped lazily, so forked DataLoader workers open their own mappings
+        if shard_id not in self.mapped:
+            shard = self.shards[shard_id]
+            self.mapped[shard_id] = (
+                np.load(os.path.join(self.shard_dir, shard["training"]), mmap_mode='r'),
+                np.load(os.path.join(self.shard_dir, shard["labels"]), mmap_mode='r')
+            )
+        return self.mapped[shard_id]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.n_samples
+        if not 0 <= index < self.n_samples:
+            raise IndexError(f"Index {index} out of range for {self.n_samples} samples")
+        rotations, labels = self._shard(index // self.samples_per_shard)
+        local_index = index % self.samples_per_shard
+        return (torch.from_numpy(np.array(rotations[local_index, :self.sequence_length])),
+                torch.from_numpy(np.array(labels[local_index])))
+
+    def __len__(self):
+        return self.n_samples
+
+    def get_batch(self, indices):
+        indices = torch.as_tensor(indices)
+        rotations = torch.empty((len(indices), self.sequence_length, self.input_size))
+        labels = torch.empty((len(indices), 1, self.input_size))
+
+        shard_ids = indices // self.samples_per_shard
+        for shard_id in shard_ids.unique().tolist():
+            positions = (shard_ids == shard_id).nonzero().squeeze(1)
+            local_indices = (indices[positions] % self.samples_per_shard).numpy()
+            # Sorted reads keep the access to the mapped shard sequential
+            order = np.argsort(local_indices)
+            shard_rotations, shard_labels = self._shard(shard_id)
+            positions = positions[torch.from_numpy(order)]
+            rotations[positions] = torch.from_numpy(shard_rotations[local_indices[order], :self.sequence_length])
+            labels[positions] = torch.from_numpy(shard_labels[local_indices[order]])
+        return rotations, labels
+
+
+class ShardBlockSampler(Sampler):
+    """
+    Global shuffle over a ShardedRotationDataset (or a Subset of it) that keeps disk reads block-local.
+
+    Samples are grouped into blocks of block_size consecutive samples within a shard.
+    The block order is shuffled globally and samples are shuffled inside windows of
+    blocks_per_window blocks, so every read touches only a few contiguous regions.
+    """
+
+    def __init__(self, dataset, block_size=256, blocks_per_window=8, generator=None):
+        indices = torch.arange(len(dataset))
+        while isinstance(dataset, Subset):
+            indices = torch.as_tensor(dataset.indices)[indices]
+            dataset = dataset.dataset
+
+        # Block id of every position, blocks never span two shards
+        shard_ids = indices // dataset.samples_per_shard
+        blocks_per_shard = (dataset.samples_per_shard + block_size - 1) // block_size
+        block_ids = shard_ids * blocks_per_shard + (indices % dataset.samples_per_shard) // block_size
+
+        order = torch.argsort(block_ids, stable=True)
+        _, counts = torch.unique_consecutive(block_ids[order], return_counts=True)
+        self.blocks =               list(order.split(counts.tolist()))
+        self.blocks_per_window =    blocks_per_window
+        self.generator =            generator
+        self.n_samples =            len(indices)
+
+    def __iter__(self):
+        block_order = torch.randperm(len(self.blocks), generator=self.generator).tolist()
+        for start in range(0, len(block_order), self.blocks_per_window):
+            window = torch.cat([self.blocks[block] for block in block_order[start:start + self.blocks_per_window]])
+            yield from window[torch.randperm(len(window), generator=self.generator)].tolist()
+
+    def __len__(self):
+        return self.n_samples
@@ -0,0 +1,96 @@
+from itertools import islice
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from dataset_initializer import parse_rotation_rows
+
+
+class StreamingRotationDataset(IterableDataset):
+    """
+    Out-of-core variant of RotationDataset for sets larger than the host's RAM.
+
+    The training and labels CSVs are read in lockstep, chunk_samples samples
+    (input_size rows each) at a time, and the dataset yields ready batches of
+    (batch_size, sequence_length, input_size) rotations with (batch_size, 1, input_size)
+    labels. Memory is bounded by one chunk plus the shuffle buffer. With several
+    DataLoader workers every worker parses every n-th chunk. Use it with
+    DataLoader(dataset, batch_size=None) and call set_epoch before every epoch,
+    the shuffle order is seeded from it.
+    """
+
+    def __init__(self, training_path, labels_path, input_size, sequence_length,
+                 batch_size=10, chunk_samples=1024, shuffle_buffer_size=0, seed=303):
+        super(StreamingRotationDataset, self).__init__()
+        self.training_path =        training_path
+        self.labels_path =          labels_path
+        self.input_size =           input_size
+        self.sequence_length =      sequence_length
+        self.batch_size =           batch_size
+        self.chunk_samples =        chunk_samples
+        self.shuffle_buffer_size =  shuffle_buffer_size
+        self.seed =                 seed
+        self.epoch =                0
+
+    def set_epoch(self, epoch):
+        # Workers iterate copies of the dataset, so the epoch is set on the original
+        self.epoch = epoch
+
+    def _read_chunks(self, worker_id, num_workers):
+        chunk_rows = self.chunk_samples * self.input_size
+
+        with open(self.training_path, 'r') as training_file, open(self.labels_path, 'r') as labels_file:
+            chunk_index = 0
+            while True:
+                training_rows = list(islice(training_file, chunk_rows))
+                labels_rows = list(islice(labels_file, chunk_rows))
+                if len(training_rows) != len(labels_rows):
+                    raise RuntimeError(
+                        f"Training and labels files have a different number of rows: {self.training_path}, {self.labels_path}")
+                if len(training_rows) < self.input_size:
+                    return
+
+                if chunk_index % num_workers == worker_id:
+                    yield (parse_rotation_rows(training_rows, self.input_size, self.sequence_length),
+                           parse_rotation_rows(labels_rows, self.input_size, 1))
+                chunk_index += 1
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch * num_workers + worker_id)
+
+        shuffle = self.shuffle_buffer_size > 0
+        buffer_size = max(self.shuffle_buffer_size, self.batch_size)
+        rotations, labels = [], []
+        n_buffered = 0
+
+        for chunk_rotations, chunk_labels in self._read_chunks(worker_id, num_workers):
+            rotations.append(chunk_rotations)
+            labels.append(chunk_labels)
+            n_buffered += chunk_rotations.size(0)
+            if n_buffered < buffer_size:
+                continue
+
+            rotations, labels = self._shuffled(rotations, labels, shuffle, generator)
+            n_full = (n_buffered // self.batch_size) * self.batch_size
+            for i in range(0, n_full, self.batch_size):
+                yield rotations[i:i + self.batch_size], labels[i:i + self.batch_size]
+
+            # Leftover samples wait for the next chunk
+            rotations, labels = [rotations[n_full:]], [labels[n_full:]]
+            n_buffered -= n_full
+
+        if n_buffered > 0:
+            rotations, labels = self._shuffled(rotations, labels, shuffle, generator)
+            for i in range(0, n_buffered, self.batch_size):
+                yield rotations[i:i + self.batch_size], labels[i:i + self.batch_size]
+
+    def _shuffled(self, rotations, labels, shuffle, generator):
+        rotations = torch.cat(rotations)
+        labels = torch.cat(labels)
+        if shuffle:
+            permutation = torch.randperm(rotations.size(0), generator=generator)
+            rotations, labels = rotations[permutation], labels[permutation]
+        return rotations, labels
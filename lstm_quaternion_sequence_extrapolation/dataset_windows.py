@@ -0,0 +1,112 @@
+import csv
+from bisect import bisect_right
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+def read_joint_tracks(file_path: str, joints=None, components=("w", "i", "j", "k")):
+    """
+    Reads continuous per-joint quaternion tracks from a source set CSV whose
+    header names columns like "LHipAngles [w]". Returns a dict joint -> contiguous
+    (frames, len(components)) float32 tensor.
+    """
+    with open(file_path, 'r') as file:
+        header = next(csv.reader(file))
+
+    if joints is None:
+        joints = []
+        for name in header:
+            joint = name.rsplit(" [", 1)[0]
+            if joint not in joints:
+                joints.append(joint)
+
+    columns = {}
+    for joint in joints:
+        try:
+            columns[joint] = [header.index(f"{joint} [{component}]") for component in components]
+        except ValueError:
+            raise ValueError(f"Joint {joint} does not have all {components} columns in {file_path}")
+
+    used_columns = sorted({column for joint_columns in columns.values() for column in joint_columns})
+    data = np.loadtxt(file_path, dtype=np.float32, delimiter=',', skiprows=1, usecols=used_columns, ndmin=2)
+    position = {column: i for i, column in enumerate(used_columns)}
+
+    return {joint: torch.from_numpy(np.ascontiguousarray(data[:, [position[c] for c in joint_columns]]))
+            for joint, joint_columns in columns.items()}
+
+
+class SlidingWindowDataset(Dataset):
+    """
+    Builds (window, future frame) pairs on the fly from continuous quaternion tracks.
+
+    Windows are strided views of the tracks, so memory scales with the recording
+    length instead of the window count and changing sequence_length needs no
+    regenerated CSVs. Sample n of a track is frames [n * stride, n * stride + sequence_length)
+    labelled with frame n * stride + sequence_length - 1 + horizon, in the same
+    (sequence_length, input_size) / (1, input_size) shapes as RotationDataset.
+    """
+
+    def __init__(self, tracks, sequence_length=100, stride=1, horizon=1):
+        super(SlidingWindowDataset, self).__init__()
+        if isinstance(tracks, torch.Tensor):
+            tracks = [tracks]
+        if stride < 1 or horizon < 1:
+            raise ValueError(f"Stride and horizon must be positive, got stride={stride}, horizon={horizon}")
+
+        self.sequence_length =  sequence_length
+        self.stride =           stride
+        self.horizon =          horizon
+        self.windows =          []
+        self.labels =           []
+        self.offsets =          [0]
+
+        for track in tracks:
+            track = track.contiguous()
+            n_windows = max((track.size(0) - sequence_length - horizon) // stride + 1, 0)
+            if n_windows == 0:
+                # Track shorter than one window and its label, unfold needs sequence_length frames
+                windows = track.new_empty((0, sequence_length) + track.shape[1:])
+                labels = track.new_empty((0, 1) + track.shape[1:])
+            else:
+                # (windows, input_size, sequence_length) view -> (windows, sequence_length, input_size)
+                windows = track.unfold(0, sequence_length, stride).transpose(1, 2)[:n_windows]
+                labels = track[sequence_length - 1 + horizon::stride][:n_windows].unsqueeze(1)
+
+            self.windows.append(windows)
+            self.labels.append(labels)
+            self.offsets.append(self.offsets[-1] + n_windows)
+
+        self.n_samples = self.offsets[-1]
+
+    @classmethod
+    def from_source_csv(cls, file_path, joints=None, sequence_length=100, stride=1, horizon=1):
+        tracks = read_joint_tracks(file_path, joints)
+        return cls(list(tracks.values()), sequence_length, stride, horizon)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.n_samples
+        if not 0 <= index < self.n_samples:
+            raise IndexError(f"Index {index} out of range for {self.n_samples} windows")
+        track = bisect_right(self.offsets, index) - 1
+        local_index = index - self.offsets[track]
+        return self.windows[track][local_index], self.labels[track][local_index]
+
+    def __len__(self):
+        return self.n_samples
+
+    def get_batch(self, indices):
+        indices = torch.as_tensor(indices)
+        if len(self.windows) == 1:
+            return self.windows[0][indices], self.labels[0][indices]
+
+        tracks = torch.bucketize(indices, torch.tensor(self.offsets[1:]), right=True)
+        rotations = torch.empty((len(indices), self.sequence_length) + self.windows[0].shape[2:])
+        labels = torch.empty((len(indices), 1) + self.labels[0].shape[2:])
+        for track in tracks.unique().tolist():
+            mask = tracks == track
+            local_indices = indices[mask] - self.offsets[track]
+            rotations[mask] = self.windows[track][local_indices]
+            labels[mask] = self.labels[track][local_indices]
+        return rotations, labels
@@ -0,0 +1,686 @@
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import torch
+
+import recurrent_models as rm
+from core_qnn.quaternion_ops import QuaternionLinearFunction, quaternion_linear, hamilton_product, q_normalize, quaternion_exp, get_r, get_i, get_j, get_k
+from core_qnn import quaternion_algebra as qa
+from scripted_models import save_scripted_model
+from streaming_predictor import StreamingPredictor, rollout
+from quaternion_encoding import angular_error
+from utilities import normalize_quaternions
+from dataset_initializer import RotationDataset, IndexBatchLoader, RecordingTrackLoader
+from synthetic_data import generate_synthetic_set
+from training import window_outputs, stateful_outputs
+
+
+def time_function(function, repeats=10, warmup=2):
+    # Mean seconds per call
+    for _ in range(warmup):
+        function()
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start_time) / repeats
+
+
+def forward_backward(model, x):
+    def step():
+        model.zero_grad()
+        model(x).sum().backward()
+    return step
+
+
+def gradients(model, x):
+    model.zero_grad()
+    output = model(x)
+    output.sum().backward()
+    return output.detach(), [p.grad.clone() for p in model.parameters()]
+
+
+def saved_activation_bytes(model, x):
+    # Bytes of the tensors autograd keeps for backward during one forward (shared storages counted once)
+    storages = {}
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        model(x)
+    return sum(storages.values())
+
+
+def max_difference(first, second):
+    return max((a - b).abs().max().item() for a, b in zip(first, second))
+
+
+def create_model(model_type, hidden_size=128, num_layers=2):
+    if model_type is rm.LSTM:
+        return rm.LSTM(4, hidden_size, num_layers, 4, 'cpu')
+    return model_type(4, hidden_size, num_layers, batch_first=True, device='cpu')
+
+
+def legacy_qlstm_forward(layer, x):
+    # Reference QLSTM recurrence calling the quaternion layers at every timestep
+    h = torch.zeros(x.shape[1], layer.hidden_dim, device=x.device)
+    c = h
+    wfx_out, wix_out, wox_out, wcx_out = layer.wfx(x), layer.wix(x), layer.wox(x), layer.wcx(x)
+    out = []
+    for k in range(x.shape[0]):
+        ft = layer.act_gate(wfx_out[k] + layer.ufh(h))
+        it = layer.act_gate(wix_out[k] + layer.uih(h))
+        ot = layer.act_gate(wox_out[k] + layer.uoh(h))
+        at = wcx_out[k] + layer.uch(h)
+        c = it * layer.act(at) + ft * c
+        h = ot * layer.act(c)
+        out.append(layer.fco(h).unsqueeze(0))
+    return normalize_quaternions(torch.cat(out, 0), dim=2)
+
+
+class LegacyStackedQLSTM(torch.nn.Module):
+    def __init__(self, model):
+        super(LegacyStackedQLSTM, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        x = x.permute(1, 0, 2)
+        for layer in self.model.layers:
+            x = legacy_qlstm_forward(layer, x)
+        return x.permute(1, 0, 2)[:, -1, :]
+
+
+class LegacyQuaternionLinearFunction(QuaternionLinearFunction):
+    # Previous backward, materializing 4x copies of the input and gradient
+    @staticmethod
+    def backward(ctx, grad_output):
+
+        input, r_weight, i_weight, j_weight, k_weight, bias = ctx.saved_tensors
+        grad_input = grad_weight_r = grad_weight_i = grad_weight_j = grad_weight_k = grad_bias = None
+
+        input_r = torch.cat([r_weight, -i_weight, -j_weight, -k_weight], dim=0)
+        input_i = torch.cat([i_weight,  r_weight, -k_weight, j_weight], dim=0)
+        input_j = torch.cat([j_weight,  k_weight, r_weight, -i_weight], dim=0)
+        input_k = torch.cat([k_weight,  -j_weight, i_weight, r_weight], dim=0)
+        cat_kernels_4_quaternion_T = torch.cat([input_r, input_i, input_j, input_k], dim=1).permute(1,0)
+
+        r = get_r(input)
+        i = get_i(input)
+        j = get_j(input)
+        k = get_k(input)
+        input_r = torch.cat([r, -i, -j, -k], dim=0)
+        input_i = torch.cat([i,  r, -k, j], dim=0)
+        input_j = torch.cat([j,  k, r, -i], dim=0)
+        input_k = torch.cat([k,  -j, i, r], dim=0)
+        input_mat = torch.cat([input_r, input_i, input_j, input_k], dim=1)
+
+        r = get_r(grad_output)
+        i = get_i(grad_output)
+        j = get_j(grad_output)
+        k = get_k(grad_output)
+        input_r = torch.cat([r, i, j, k], dim=1)
+        input_i = torch.cat([-i,  r, k, -j], dim=1)
+        input_j = torch.cat([-j,  -k, r, i], dim=1)
+        input_k = torch.cat([-k,  j, -i, r], dim=1)
+        grad_mat = torch.cat([input_r, input_i, input_j, input_k], dim=0)
+
+        if ctx.needs_input_grad[0]:
+            grad_input  = grad_output.mm(cat_kernels_4_quaternion_T)
+        if ctx.needs_input_grad[1]:
+            grad_weight = grad_mat.permute(1,0).mm(input_mat).permute(1,0)
+            unit_size_x = r_weight.size(0)
+            unit_size_y = r_weight.size(1)
+            grad_weight_r = grad_weight.narrow(0,0,unit_size_x).narrow(1,0,unit_size_y)
+            grad_weight_i = grad_weight.narrow(0,0,unit_size_x).narrow(1,unit_size_y,unit_size_y)
+            grad_weight_j = grad_weight.narrow(0,0,unit_size_x).narrow(1,unit_size_y*2,unit_size_y)
+            grad_weight_k = grad_weight.narrow(0,0,unit_size_x).narrow(1,unit_size_y*3,unit_size_y)
+        if ctx.needs_input_grad[5]:
+            grad_bias   = grad_output.sum(0).squeeze(0)
+
+        return grad_input, grad_weight_r, grad_weight_i, grad_weight_j, grad_weight_k, grad_bias
+
+
+def legacy_conjugate(q):
+    # QALLoss.quaternion_conjugate before quaternion_algebra
+    w, v = q[:, 0], q[:, 1:]
+    return torch.cat((w.unsqueeze(-1), -v), dim=1)
+
+
+def legacy_multiply(q1, q2):
+    # QALLoss.quaternion_multiply before quaternion_algebra
+    w1, v1 = q1[:, 0], q1[:, 1:]
+    w2, v2 = q2[:, 0], q2[:, 1:]
+
+    w = w1 * w2 - (v1 * v2).sum(dim=1)
+    v = w1.unsqueeze(-1) * v2 + w2.unsqueeze(-1) * v1 + torch.linalg.cross(v1, v2, dim=1)
+
+    return torch.cat((w.unsqueeze(-1), v), dim=1)
+
+
+def legacy_qal_loss(output, expected):
+    # QALLoss.forward before quaternion_algebra
+    w = legacy_multiply(legacy_conjugate(output), expected)[:, 0]
+    angles_rad = 2 * torch.acos(torch.clamp(w, -1.0 + 1e-4, 1.0 - 1e-4))
+    return torch.mean(angles_rad**2)
+
+
+def unfused_qal_loss(output, expected, reduction='mean'):
+    # QALLoss.forward before QALLossFunction, full Hamilton product through autograd
+    w = qa.multiply(qa.conjugate(output), expected)[:, 0]
+    angles_rad = 2 * torch.acos(torch.clamp(w, -1.0 + 1e-4, 1.0 - 1e-4))
+    losses = angles_rad**2
+    return losses if reduction == 'none' else torch.mean(losses)
+
+
+def legacy_hamilton_product(q0, q1):
+    # core_qnn hamilton_product before quaternion_algebra, (batch_size, 4 * n) r/i/j/k blocks
+    q1_r, q1_i, q1_j, q1_k = get_r(q1), get_i(q1), get_j(q1), get_k(q1)
+    r_base = torch.mul(q0, q1)
+    r = get_r(r_base) - get_i(r_base) - get_j(r_base) - get_k(r_base)
+    i_base = torch.mul(q0, torch.cat([q1_i, q1_r, q1_k, q1_j], dim=1))
+    i = get_r(i_base) + get_i(i_base) + get_j(i_base) - get_k(i_base)
+    j_base = torch.mul(q0, torch.cat([q1_j, q1_k, q1_r, q1_i], dim=1))
+    j = get_r(j_base) - get_i(j_base) + get_j(j_base) + get_k(j_base)
+    k_base = torch.mul(q0, torch.cat([q1_k, q1_j, q1_i, q1_r], dim=1))
+    k = get_r(k_base) + get_i(k_base) - get_j(k_base) + get_k(k_base)
+    return torch.cat([r, i, j, k], dim=1)
+
+
+def legacy_q_normalize(input):
+    # core_qnn q_normalize before quaternion_algebra
+    r, i, j, k = get_r(input), get_i(input), get_j(input), get_k(input)
+    norm = torch.sqrt(r*r + i*i + j*j + k*k + 0.0001)
+    return torch.cat([r / norm, i / norm, j / norm, k / norm], dim=1)
+
+
+def legacy_quaternion_exp(input):
+    # core_qnn quaternion_exp before quaternion_algebra, without the 1e-4 added to |v| so outputs are comparable
+    r, i, j, k = get_r(input), get_i(input), get_j(input), get_k(input)
+    norm_v = torch.sqrt(i*i + j*j + k*k)
+    exp = torch.exp(r)
+    return torch.cat([exp * torch.cos(norm_v), exp * (i / norm_v) * torch.sin(norm_v),
+                      exp * (j / norm_v) * torch.sin(norm_v), exp * (k / norm_v) * torch.sin(norm_v)], dim=1)
+
+
+def legacy_exp(q):
+    # Per-component exp of (n, 4) quaternions
+    w, v = q[:, :1], q[:, 1:]
+    angle = torch.sqrt((v * v).sum(dim=1, keepdim=True))
+    return torch.cat([torch.exp(w) * torch.cos(angle), torch.exp(w) * v / angle * torch.sin(angle)], dim=1)
+
+
+def legacy_log(q):
+    # Per-component log of nonzero (n, 4) quaternions
+    w, v = q[:, :1], q[:, 1:]
+    v_norm = torch.sqrt((v * v).sum(dim=1, keepdim=True))
+    norm = torch.sqrt((q * q).sum(dim=1, keepdim=True))
+    return torch.cat([torch.log(norm), v / v_norm * torch.atan2(v_norm, w)], dim=1)
+
+
+def legacy_geodesic_angle(q1, q2):
+    # Rotation angle from the dot product, inputs normalized so gradients are tangent to the unit sphere.
+    # The acos gradient loses precision near |dot| = 1, so gradient differences there are errors of this reference
+    q1, q2 = legacy_q_normalize(q1), legacy_q_normalize(q2)
+    return 2 * torch.acos(torch.clamp((q1 * q2).sum(dim=1).abs(), max=1.0))
+
+
+def unit_geodesic_angle(q1, q2):
+    return qa.geodesic_angle(qa.normalize(q1, eps=0.0001), qa.normalize(q2, eps=0.0001))
+
+
+def allocation_events(function):
+    # Number of allocating operations and bytes allocated on the CPU by one call of function
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as profiler:
+        function()
+    allocations = [event.self_cpu_memory_usage for event in profiler.events() if event.self_cpu_memory_usage > 0]
+    return len(allocations), sum(allocations)
+
+
+def backward_allocations(function):
+    # Seconds and bytes allocated on the CPU by one call of function
+    start_time = time.perf_counter()
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as profiler:
+        function()
+    elapsed = time.perf_counter() - start_time
+    return elapsed, sum(event.self_cpu_memory_usage for event in profiler.events() if event.self_cpu_memory_usage > 0)
+
+
+def forward_retained_bytes(model, x):
+    # Net bytes still allocated after one forward, i.e. what the autograd graph keeps alive until backward
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as profiler:
+        output = model(x)
+    return output, sum(event.self_cpu_memory_usage for event in profiler.events())
+
+
+def benchmark_hamilton_caching(hidden_size=128, num_layers=2, batch_size=10, sequence_length=100):
+    print(f"\n>>> Hamilton matrix caching (hidden {hidden_size}, batch {batch_size}, {sequence_length} steps) <<<")
+    torch.manual_seed(303)
+    model = rm.StackedQLSTM(4, hidden_size, num_layers, batch_first=True, device='cpu', fused=False)
+    legacy = LegacyStackedQLSTM(model)
+    x = torch.randn(batch_size, sequence_length, 4)
+
+    layer = model.layers[1]
+    h = torch.randn(batch_size, hidden_size)
+    weights = [module.expanded_weight() for module in (layer.ufh, layer.uih, layer.uoh, layer.uch)]
+    with torch.no_grad():
+        rebuilt_step = time_function(lambda: [module(h) for module in (layer.ufh, layer.uih, layer.uoh, layer.uch)], repeats=1000)
+        cached_step = time_function(lambda: [torch.mm(h, weight) for weight in weights], repeats=1000)
+    print(f"Recurrent step, rebuilding matrices: {rebuilt_step * 1e6:.1f}us, cached matrices: {cached_step * 1e6:.1f}us ({rebuilt_step / cached_step:.2f}x)")
+
+    legacy_time = time_function(forward_backward(legacy, x), repeats=5)
+    cached_time = time_function(forward_backward(model, x), repeats=5)
+    print(f"Forward + backward, legacy: {legacy_time * 1000:.1f}ms, cached: {cached_time * 1000:.1f}ms ({legacy_time / cached_time:.2f}x)")
+
+    legacy_output, legacy_gradients = gradients(legacy, x)
+    output, model_gradients = gradients(model, x)
+    print(f"Max output difference: {(legacy_output - output).abs().max().item():.2e}, max gradient difference: {max_difference(legacy_gradients, model_gradients):.2e}")
+
+
+def benchmark_fused_qlstm(checkpoint_path=None, hidden_size=128, num_layers=2, batch_size=10, sequence_length=100):
+    print(f"\n>>> Fused-gate QLSTM (hidden {hidden_size}, batch {batch_size}, {sequence_length} steps) <<<")
+    torch.manual_seed(303)
+    model = rm.StackedQLSTM(4, hidden_size, num_layers, batch_first=True, device='cpu', fused=False)
+    if checkpoint_path is not None:
+        print(f"Checkpoint: {checkpoint_path}")
+        model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+    fused = rm.fuse_stacked_qlstm(model)
+    x = normalize_quaternions(torch.randn(batch_size, sequence_length, 4), dim=2)
+
+    unfused_time = time_function(forward_backward(model, x), repeats=5)
+    fused_time = time_function(forward_backward(fused, x), repeats=5)
+    print(f"Forward + backward, QLSTM: {unfused_time * 1000:.1f}ms, FusedQLSTM: {fused_time * 1000:.1f}ms ({unfused_time / fused_time:.2f}x)")
+
+    with torch.no_grad():
+        unfused_inference = time_function(lambda: model(x), repeats=5)
+        fused_inference = time_function(lambda: fused(x), repeats=5)
+    print(f"Inference, QLSTM: {unfused_inference * 1000:.1f}ms, FusedQLSTM: {fused_inference * 1000:.1f}ms ({unfused_inference / fused_inference:.2f}x)")
+
+    output, model_gradients = gradients(model, x)
+    fused_output, fused_gradients = gradients(fused, x)
+    print(f"Max output difference: {(output - fused_output).abs().max().item():.2e}, max gradient difference: {max_difference(model_gradients, fused_gradients):.2e}")
+
+
+def benchmark_lowered_qlstm(checkpoint_path=None, hidden_size=128, num_layers=2, batch_size=10, sequence_length=100):
+    print(f"\n>>> QLSTM lowered to nn.LSTM (hidden {hidden_size}, batch {batch_size}, {sequence_length} steps) <<<")
+    torch.manual_seed(303)
+    model = rm.StackedQLSTM(4, hidden_size, num_layers, batch_first=True, device='cpu')
+    if checkpoint_path is not None:
+        print(f"Checkpoint: {checkpoint_path}")
+        model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+    model.eval()
+    lowered = rm.LoweredStackedQLSTM(model).eval()
+    x = normalize_quaternions(torch.randn(batch_size, sequence_length, 4), dim=2)
+
+    with torch.no_grad():
+        qlstm_time = time_function(lambda: model(x), repeats=10)
+        lowered_time = time_function(lambda: lowered(x), repeats=10)
+        difference = (model(x) - lowered(x)).abs().max().item()
+    print(f"Inference, StackedQLSTM: {qlstm_time * 1000:.2f}ms, LoweredStackedQLSTM: {lowered_time * 1000:.2f}ms ({qlstm_time / lowered_time:.2f}x)")
+    print(f"Max output difference: {difference:.2e}")
+
+
+def benchmark_scripted_models(hidden_size=128, num_layers=2, batch_size=10, sequence_length=100):
+    print(f"\n>>> TorchScript models (hidden {hidden_size}, batch {batch_size}, {sequence_length} steps) <<<")
+    x = normalize_quaternions(torch.randn(batch_size, sequence_length, 4), dim=2)
+
+    for model_type in (rm.StackedQLSTM, rm.VectorizedStackedQLSTM):
+        torch.manual_seed(303)
+        model = model_type(4, hidden_size, num_layers, batch_first=True, device='cpu').eval()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "model.pt")
+            scripted = save_scripted_model(model, path)
+
+            # The artifact is loaded by a fresh interpreter outside of the repository
+            torch.save(x, os.path.join(directory, "x.pt"))
+            loader = "import sys, torch; m = torch.jit.load(sys.argv[1]); torch.save(m(torch.load(sys.argv[2])), sys.argv[3])"
+            subprocess.run([sys.executable, "-c", loader, path, os.path.join(directory, "x.pt"), os.path.join(directory, "y.pt")],
+                           check=True, cwd=directory)
+            standalone = torch.load(os.path.join(directory, "y.pt"))
+
+        with torch.no_grad():
+            eager_time = time_function(lambda: model(x), repeats=10)
+            scripted_time = time_function(lambda: scripted(x), repeats=10)
+            difference = max((model(x) - scripted(x)).abs().max().item(), (model(x) - standalone).abs().max().item())
+        print(f"{model_type.__name__}, eager: {eager_time * 1000:.2f}ms, scripted: {scripted_time * 1000:.2f}ms ({eager_time / scripted_time:.2f}x)")
+        print(f"Max output difference (in process and standalone): {difference:.2e}")
+
+
+def benchmark_compiled_models(hidden_size=128, num_layers=2, batch_size=10, sequence_length=100, backward=False):
+    mode = "forward + backward" if backward else "inference"
+    print(f"\n>>> torch.compile, {mode} (hidden {hidden_size}, batch {batch_size}, {sequence_length} steps) <<<")
+    x = normalize_quaternions(torch.randn(batch_size, sequence_length, 4), dim=2)
+
+    for model_type in (rm.LSTM, rm.StackedQLSTM, rm.VectorizedStackedQLSTM):
+        torch.manual_seed(303)
+        model = create_model(model_type, hidden_size, num_layers)
+        if not backward:
+            model.eval()
+
+        print(f"{model_type.__name__}:")
+        start_time = time.perf_counter()
+        compiled = rm.compile_model(model, x, backward=backward)
+        warmup_time = time.perf_counter() - start_time
+        if compiled is model:
+            continue
+
+        if backward:
+            eager_time = time_function(forward_backward(model, x), repeats=10)
+            compiled_time = time_function(forward_backward(compiled, x), repeats=10)
+            difference = max_difference(gradients(model, x)[1], gradients(compiled, x)[1])
+        else:
+            with torch.no_grad():
+                eager_time = time_function(lambda: model(x), repeats=10)
+                compiled_time = time_function(lambda: compiled(x), repeats=10)
+                difference = (model(x) - compiled(x)).abs().max().item()
+
+        saved_time = eager_time - compiled_time
+        break_even = f"{warmup_time / saved_time:.0f} calls" if saved_time > 0 else "never"
+        print(f"Eager: {eager_time * 1000:.2f}ms, compiled: {compiled_time * 1000:.2f}ms ({eager_time / compiled_time:.2f}x), "
+              f"warm-up: {warmup_time:.1f}s, pays off after: {break_even}")
+        print(f"Max difference: {difference:.2e}")
+
+
+def benchmark_streaming_predictor(hidden_size=128, num_layers=2, n_streams=10, sequence_length=100):
+    print(f"\n>>> Streaming predictor (hidden {hidden_size}, {n_streams} streams, {sequence_length} frames) <<<")
+    x = normalize_quaternions(torch.randn(n_streams, sequence_length, 4), dim=2)
+
+    for model_type in (rm.LSTM, rm.StackedQLSTM, rm.VectorizedStackedQLSTM):
+        torch.manual_seed(303)
+        model = create_model(model_type, hidden_size, num_layers).eval()
+        predictor = StreamingPredictor(model, capacity=4)
+        stream_ids = [f"stream_{i}" for i in range(n_streams)]
+
+        # Every streamed prediction equals the window model on the frames seen so far
+        difference = 0.0
+        with torch.no_grad():
+            for t in range(sequence_length):
+                streamed = predictor.step(stream_ids, x[:, t])
+                difference = max(difference, (streamed - model(x[:, :t + 1])).abs().max().item())
+
+            # Evicted and reset streams restart from zero state, other streams are untouched
+            predictor.evict(stream_ids[:2])
+            predictor.reset(stream_ids[2:4])
+            restarted = predictor.step(stream_ids[:4], x[:4, 0])
+            difference = max(difference, (restarted - model(x[:4, :1])).abs().max().item())
+
+            window_time = time_function(lambda: model(x), repeats=10)
+            frame = x[:, -1]
+            streaming_time = time_function(lambda: predictor.step(stream_ids, frame), repeats=100)
+        print(f"{model_type.__name__}, per frame, window re-run: {window_time * 1000:.2f}ms, streaming: {streaming_time * 1000:.3f}ms "
+              f"({window_time / streaming_time:.1f}x), max difference: {difference:.2e}")
+
+
+def window_rollout(model, sequences, n_frames, sliding=True):
+    # Naive extrapolation re-running the model on the window extended by every prediction
+    window = sequences
+    output = []
+    with torch.no_grad():
+        for _ in range(n_frames):
+            prediction = model(window)
+            output.append(prediction)
+            window = torch.cat([window[:, 1:] if sliding else window, prediction.unsqueeze(1)], dim=1)
+    return torch.stack(output, dim=1)
+
+
+def benchmark_rollout(hidden_size=128, num_layers=2, batch_size=10, sequence_length=100, n_frames=50):
+    print(f"\n>>> Autoregressive rollout (hidden {hidden_size}, batch {batch_size}, {sequence_length} frames, {n_frames} future frames) <<<")
+    x = normalize_quaternions(torch.randn(batch_size, sequence_length, 4), dim=2)
+
+    for model_type in (rm.LSTM, rm.StackedQLSTM, rm.VectorizedStackedQLSTM):
+        torch.manual_seed(303)
+        model = create_model(model_type, hidden_size, num_layers).eval()
+
+        stateful = rollout(model, x, n_frames)
+        growing = window_rollout(model, x, n_frames, sliding=False)
+        sliding = window_rollout(model, x, n_frames)
+
+        sliding_time = time_function(lambda: window_rollout(model, x, n_frames), repeats=2, warmup=1)
+        rollout_time = time_function(lambda: rollout(model, x, n_frames), repeats=5, warmup=1)
+        print(f"{model_type.__name__}, sliding window re-feeding: {sliding_time * 1000:.1f}ms, stateful rollout: {rollout_time * 1000:.1f}ms "
+              f"({sliding_time / rollout_time:.1f}x), shape: {tuple(stateful.shape)}")
+        print(f"Max difference to growing window: {(stateful - growing).abs().max().item():.2e}, "
+              f"mean angle to sliding window: {angular_error(stateful.reshape(-1, 4), sliding.reshape(-1, 4)).mean().item():.2e} rad")
+
+
+def benchmark_last_step_projection(hidden_size=128, num_layers=2, batch_size=10, sequence_length=100):
+    print(f"\n>>> Last-step-only projection (hidden {hidden_size}, batch {batch_size}, {sequence_length} steps) <<<")
+    x = normalize_quaternions(torch.randn(batch_size, sequence_length, 4), dim=2)
+
+    for model_type in (rm.StackedQLSTM, rm.VectorizedStackedQLSTM):
+        torch.manual_seed(303)
+        model = model_type(4, hidden_size, num_layers, batch_first=True, device='cpu', last_step_only=False)
+        last_step = model_type(4, hidden_size, num_layers, batch_first=True, device='cpu', last_step_only=True)
+        last_step.load_state_dict(model.state_dict())
+
+        full_time = time_function(forward_backward(model, x), repeats=5)
+        last_step_time = time_function(forward_backward(last_step, x), repeats=5)
+        full_memory = saved_activation_bytes(model, x) / 2**20
+        last_step_memory = saved_activation_bytes(last_step, x) / 2**20
+
+        output, model_gradients = gradients(model, x)
+        last_step_output, last_step_gradients = gradients(last_step, x)
+        print(f"{model_type.__name__}, forward + backward, all steps: {full_time * 1000:.1f}ms, last step: {last_step_time * 1000:.1f}ms "
+              f"({full_time / last_step_time:.2f}x)")
+        print(f"Saved activations, all steps: {full_memory:.2f}MB, last step: {last_step_memory:.2f}MB")
+        print(f"Identical predictions: {torch.equal(output, last_step_output)}, "
+              f"max gradient difference: {max_difference(model_gradients, last_step_gradients):.2e}")
+
+
+def benchmark_vectorized_qlstm(checkpoint_path, hidden_size=128, num_layers=2, batch_size=10, sequence_length=100):
+    print(f"\n>>> VectorizedQLSTM converted from QLSTM (hidden {hidden_size}, batch {batch_size}, {sequence_length} steps) <<<")
+    print(f"Checkpoint: {checkpoint_path}")
+    model = rm.StackedQLSTM(4, hidden_size, num_layers, batch_first=True, device='cpu')
+    model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+
+    with tempfile.TemporaryDirectory() as directory:
+        converted_path = os.path.join(directory, "VectorizedQLSTM.pth")
+        rm.convert_qlstm_checkpoint(checkpoint_path, converted_path)
+        vectorized = rm.VectorizedStackedQLSTM(4, hidden_size, num_layers, batch_first=True, device='cpu')
+        vectorized.load_state_dict(torch.load(converted_path))
+    x = normalize_quaternions(torch.randn(batch_size, sequence_length, 4), dim=2)
+
+    qlstm_time = time_function(forward_backward(model, x), repeats=5)
+    vectorized_time = time_function(forward_backward(vectorized, x), repeats=5)
+    print(f"Forward + backward, StackedQLSTM: {qlstm_time * 1000:.1f}ms, VectorizedStackedQLSTM: {vectorized_time * 1000:.1f}ms ({qlstm_time / vectorized_time:.2f}x)")
+
+    with torch.no_grad():
+        qlstm_inference = time_function(lambda: model(x), repeats=10)
+        vectorized_inference = time_function(lambda: vectorized(x), repeats=10)
+    print(f"Inference, StackedQLSTM: {qlstm_inference * 1000:.1f}ms, VectorizedStackedQLSTM: {vectorized_inference * 1000:.1f}ms ({qlstm_inference / vectorized_inference:.2f}x)")
+
+    output, _ = gradients(model, x)
+    vectorized_output, _ = gradients(vectorized, x)
+    layer = model.layers[0]
+    sequence_difference = (layer(x.permute(1, 0, 2)).permute(1, 0, 2) - vectorized.layers[0](x)).abs().max().item()
+    print(f"Max output difference: {(output - vectorized_output).abs().max().item():.2e}, full sequence layer output: {sequence_difference:.2e}")
+
+
+def benchmark_quaternion_linear_backward(n_rows=1000, in_features=512, out_features=512):
+    print(f"\n>>> QuaternionLinearFunction backward ({n_rows} x {in_features} -> {out_features}) <<<")
+    torch.manual_seed(303)
+    input = torch.randn(n_rows, in_features, requires_grad=True)
+    weights = [torch.randn(in_features // 4, out_features // 4, requires_grad=True) for _ in range(4)]
+    bias = torch.randn(out_features, requires_grad=True)
+    grad_output = torch.randn(n_rows, out_features)
+
+    results = {}
+    for function in (LegacyQuaternionLinearFunction, QuaternionLinearFunction):
+        output = function.apply(input, *weights, bias)
+        backward = lambda: torch.autograd.grad(output, [input, *weights, bias], grad_output, retain_graph=True)
+        backward_time = time_function(backward, repeats=10)
+        _, allocated = backward_allocations(backward)
+        results[function.__name__] = backward()
+        print(f"{function.__name__}, backward: {backward_time * 1000:.2f}ms, allocated: {allocated / 2**20:.2f}MB")
+
+    legacy, lean = results.values()
+    reference = torch.autograd.grad(quaternion_linear(input, *weights, bias), [input, *weights, bias], grad_output)
+    print(f"Max gradient difference to plain autograd, legacy: {max_difference(legacy, reference):.2e}, lean: {max_difference(lean, reference):.2e}")
+
+    weights_64 = [torch.randn(2, 3, dtype=torch.double, requires_grad=True) for _ in range(4)]
+    bias_64 = torch.randn(12, dtype=torch.double, requires_grad=True)
+    for shape in ((6, 8), (5, 3, 8)):
+        input_64 = torch.randn(*shape, dtype=torch.double, requires_grad=True)
+        checks = [torch.autograd.gradcheck(QuaternionLinearFunction.apply, [input_64, *weights_64, bias]) for bias in (bias_64, None)]
+        # Sequence first input sliced out of a batch first tensor, as in VectorizedQLSTM
+        if len(shape) == 3:
+            checks.append(torch.autograd.gradcheck(QuaternionLinearFunction.apply, [input_64.transpose(0, 1), *weights_64, bias_64]))
+        print(f"Gradient check {shape}: {all(checks)}")
+
+
+def benchmark_sequence_projection(sequence_length=100, batch_size=10, hidden_size=128):
+    print(f"\n>>> Whole-sequence input projection ({sequence_length} x {batch_size} x 4 -> {hidden_size}) <<<")
+    torch.manual_seed(303)
+    layer = rm.QuaternionLinearAutograd(4, hidden_size)
+    parameters = [layer.r_weight, layer.i_weight, layer.j_weight, layer.k_weight, layer.bias]
+    x = torch.randn(sequence_length, batch_size, 4, requires_grad=True)
+    grad_output = torch.randn(sequence_length, batch_size, hidden_size)
+
+    results = []
+    for name, function in (("plain autograd", quaternion_linear), ("custom autograd", QuaternionLinearFunction.apply)):
+        output = function(x, *parameters)
+        backward = lambda: torch.autograd.grad(output, [x, *parameters], grad_output, retain_graph=True)
+        backward_time = time_function(backward, repeats=20)
+        _, allocated = backward_allocations(backward)
+        results.append(backward())
+        print(f"{name}, backward: {backward_time * 1000:.3f}ms, allocated: {allocated / 2**10:.1f}KB")
+    print(f"Max gradient difference: {max_difference(*results):.2e}")
+
+
+def benchmark_activation_checkpointing(sequence_lengths=(100, 500, 1000, 2000, 5000), checkpoint_steps=50,
+                                       hidden_size=128, num_layers=2, batch_size=10):
+    print(f"\n>>> Activation checkpointing every {checkpoint_steps} steps (hidden {hidden_size}, batch {batch_size}) <<<")
+    for model_type in (rm.StackedQLSTM, rm.VectorizedStackedQLSTM):
+        torch.manual_seed(303)
+        model = create_model(model_type, hidden_size, num_layers)
+        checkpointed = model_type(4, hidden_size, num_layers, batch_first=True, device='cpu', checkpoint_steps=checkpoint_steps)
+        checkpointed.load_state_dict(model.state_dict())
+
+        print(f"{model_type.__name__}:")
+        for sequence_length in sequence_lengths:
+            x = torch.randn(batch_size, sequence_length, 4)
+            repeats = max(1, 500 // sequence_length)
+            results = []
+            for name, candidate in (("full graph", model), ("checkpointed", checkpointed)):
+                _, retained = forward_retained_bytes(candidate, x)
+                elapsed = time_function(forward_backward(candidate, x), repeats=repeats, warmup=1)
+                results.append(gradients(candidate, x)[1])
+                print(f"  {sequence_length:>5} frames, {name}: forward+backward {elapsed * 1000:.1f}ms, "
+                      f"retained by forward {retained / 2**20:.2f}MB")
+            print(f"  {sequence_length:>5} frames, max gradient difference: {max_difference(*results):.2e}")
+
+
+def benchmark_stateful_training(hidden_size=128, num_layers=2, batch_size=10, sequence_length=100,
+                                n_recordings=4, n_frames=600, num_epochs=3):
+    print(f"\n>>> Stateful truncated-BPTT vs windowed training ({n_recordings} recordings x {n_frames} frames, stride 1) <<<")
+    with tempfile.TemporaryDirectory() as directory:
+        training_path, labels_path = generate_synthetic_set(directory, n_recordings, 1, n_frames, sequence_length, stride=1)
+        dataset = RotationDataset(training_path, labels_path, 4, sequence_length, use_cache=False)
+        window_loader = IndexBatchLoader(dataset, batch_size=batch_size)
+        track_loader = RecordingTrackLoader(dataset, batch_size=batch_size)
+        print(f"Frames encoded per epoch, windowed: {len(dataset) * sequence_length}, stateful: {track_loader.n_frames}")
+
+        criterion = rm.QALLoss()
+        for model_type in (rm.StackedQLSTM, rm.VectorizedStackedQLSTM):
+            for name in ("windowed", "stateful"):
+                torch.manual_seed(303)
+                model = create_model(model_type, hidden_size, num_layers)
+                optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+
+                start_time = time.perf_counter()
+                n_steps = 0
+                for _ in range(num_epochs):
+                    if name == "stateful":
+                        batches = stateful_outputs(model, track_loader, sequence_length, 'cpu')
+                    else:
+                        batches = window_outputs(model, window_loader, 'cpu')
+                    for outputs, labels in batches:
+                        loss = criterion(outputs, labels)
+                        optimizer.zero_grad()
+                        loss.backward()
+                        optimizer.step()
+                        n_steps += 1
+                epoch_time = (time.perf_counter() - start_time) / num_epochs
+
+                with torch.no_grad():
+                    window_loss = sum(criterion(model(rotations), labels.reshape(-1, 4)).item() * len(labels)
+                                      for rotations, labels in window_loader) / len(dataset)
+                print(f"{model_type.__name__}, {name}: {epoch_time:.2f}s per epoch, {n_steps // num_epochs} steps per epoch, "
+                      f"window QAL after {num_epochs} epochs {window_loss:.5f}")
+
+
+def benchmark_quaternion_algebra(sizes=(10, 10000), n_blocks=64):
+    for n_quaternions in sizes:
+        print(f"\n>>> Quaternion algebra ({n_quaternions} quaternions, forward+backward) <<<")
+        torch.manual_seed(303)
+        q1, q2 = (torch.randn(n_quaternions, 4, requires_grad=True) for _ in range(2))
+        b1, b2 = (torch.randn(max(n_quaternions // n_blocks, 1), 4 * n_blocks, requires_grad=True) for _ in range(2))
+        # Conv layout (batch, 4 * channels, height, width), the r/i/j/k blocks sit on dim 1
+        c1, c2 = (torch.randn(max(n_quaternions // (n_blocks * 16), 1), 4 * n_blocks, 4, 4, requires_grad=True) for _ in range(2))
+        unit = normalize_quaternions(torch.randn(n_quaternions, 4), dim=1)
+
+        cases = (
+            ("product (QALLoss)",       legacy_multiply,            qa.multiply,        (q1, q2)),
+            ("product (core_qnn)",      legacy_hamilton_product,    hamilton_product,   (b1, b2)),
+            ("product (core_qnn, 4-D)", legacy_hamilton_product,    hamilton_product,   (c1, c2)),
+            ("conjugate",               legacy_conjugate,           qa.conjugate,       (q1,)),
+            ("normalize (core_qnn)",    legacy_q_normalize,         q_normalize,        (b1,)),
+            ("exp",                     legacy_exp,                 qa.exp,             (q1,)),
+            ("exp (core_qnn)",          legacy_quaternion_exp,      quaternion_exp,     (b1,)),
+            ("log",                     legacy_log,                 qa.log,             (q1,)),
+            ("geodesic angle",          legacy_geodesic_angle,      unit_geodesic_angle, (q1, q2)),
+            ("QAL loss",                legacy_qal_loss,            unfused_qal_loss,   (q1, unit)),
+        )
+        for name, legacy, unified, inputs in cases:
+            results = []
+            for label, function in (("legacy", legacy), ("unified", unified)):
+                step = lambda: torch.autograd.grad(function(*inputs).sum(), [x for x in inputs if x.requires_grad])
+                elapsed = time_function(step, repeats=50)
+                n_allocations, allocated = allocation_events(step)
+                results.append([function(*inputs).detach(), *step()])
+                print(f"{name}, {label}: {elapsed * 1e6:.0f}us, {n_allocations} allocations, {allocated / 2**10:.1f}KB")
+            print(f"{name}, max difference (output and gradients): {max_difference(*results):.2e}")
+
+
+def benchmark_qal_loss(sizes=(10, 10000)):
+    for n_samples in sizes:
+        print(f"\n>>> Fused QAL loss ({n_samples} samples, forward+backward) <<<")
+        torch.manual_seed(303)
+        output = normalize_quaternions(torch.randn(n_samples, 4), dim=1).requires_grad_()
+        expected = normalize_quaternions(torch.randn(n_samples, 4), dim=1)
+
+        results = []
+        for name, loss in (("QALLoss before", unfused_qal_loss), ("QALLoss fused", rm.QALLoss())):
+            step = lambda: torch.autograd.grad(loss(output, expected), output)
+            elapsed = time_function(step, repeats=100)
+            n_allocations, allocated = allocation_events(step)
+            saved = saved_activation_bytes(lambda x: loss(x, expected), output)
+            results.append([loss(output, expected).detach(), *step()])
+            print(f"{name}: {elapsed * 1e6:.0f}us, {n_allocations} allocations, {allocated / 2**10:.1f}KB, "
+                  f"saved for backward {saved / 2**10:.1f}KB")
+        print(f"Max difference (loss and gradient): {max_difference(*results):.2e}")
+
+        with torch.no_grad():
+            per_sample = rm.QALLoss(reduction='none')(output, expected)
+            print(f"Per sample, max difference: {(per_sample - unfused_qal_loss(output, expected, 'none')).abs().max().item():.2e}, "
+                  f"mean matches reduced loss: {torch.allclose(per_sample.mean(), results[1][0])}")
+
+
+if __name__ == "__main__":
+    benchmark_hamilton_caching()
+    benchmark_fused_qlstm(r"./models/QLSTM_qal_hip_epochs25.pth")
+    benchmark_lowered_qlstm(r"./models/QLSTM_qal_hip_epochs25.pth")
+    benchmark_scripted_models()
+    benchmark_compiled_models()
+    benchmark_streaming_predictor()
+    benchmark_rollout()
+    benchmark_last_step_projection()
+    benchmark_vectorized_qlstm(r"./models/QLSTM_qal_hip_epochs25.pth")
+    benchmark_quaternion_linear_backward()
+    benchmark_sequence_projection()
+    benchmark_activation_checkpointing()
+    benchmark_stateful_training()
+    benchmark_quaternion_algebra()
+    benchmark_qal_loss()
@@ -0,0 +1,89 @@
+import math
+import torch
+
+from core_qnn import quaternion_algebra as qa
+
+# Smallest-three encoding: the largest |component| of a unit quaternion is dropped
+# and rebuilt from the other three, which all lie in [-1/sqrt(2), 1/sqrt(2)]
+COMPONENT_LIMIT =   1 / math.sqrt(2)
+QUANTIZATION_MAX =  2**15 - 1
+QUANTIZATION_STEP = COMPONENT_LIMIT / QUANTIZATION_MAX
+
+# Positions of the three stored components for every dropped component
+_KEPT_COMPONENTS = torch.tensor([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])
+
+
+class CompactQuaternions:
+    """
+    Unit quaternions of shape (..., 4) stored in 7 bytes instead of 16.
+
+    components: int16 (..., 3), the three smallest components quantized to 16 bits
+    selectors:  uint8 (...), index of the dropped component in bits 0-1 and its sign in bit 2
+
+    Keeping the sign of the dropped component makes decoding sign-exact, so models
+    trained with MSE see the same quaternions as before. Indexing works on the
+    leading dimensions and returns CompactQuaternions, decode() restores float32.
+    """
+
+    def __init__(self, components, selectors):
+        self.components =   components
+        self.selectors =    selectors
+
+    @classmethod
+    def encode(cls, q):
+        q = qa.normalize(q)
+        dropped = q.abs().argmax(dim=-1)
+        negative = torch.gather(q, -1, dropped.unsqueeze(-1)).squeeze(-1) < 0
+
+        kept = torch.gather(q, -1, _KEPT_COMPONENTS.to(q.device)[dropped])
+        kept = torch.where(negative.unsqueeze(-1), -kept, kept)
+        components = torch.round(kept / QUANTIZATION_STEP).clamp_(-QUANTIZATION_MAX, QUANTIZATION_MAX).to(torch.int16)
+        selectors = (dropped | (negative.to(torch.int64) << 2)).to(torch.uint8)
+        return cls(components, selectors)
+
+    def decode(self):
+        kept = self.components.to(torch.float32) * QUANTIZATION_STEP
+        selectors = self.selectors.to(torch.int64)
+        dropped = selectors & 3
+        sign = 1.0 - ((selectors >> 2) & 1).to(torch.float32) * 2.0
+
+        largest = torch.sqrt(torch.clamp(1.0 - (kept * kept).sum(dim=-1), min=0.0))
+        q = torch.empty(kept.shape[:-1] + (4,), dtype=torch.float32, device=kept.device)
+        q.scatter_(-1, _KEPT_COMPONENTS.to(kept.device)[dropped], kept)
+        q.scatter_(-1, dropped.unsqueeze(-1), largest.unsqueeze(-1))
+        return q * sign.unsqueeze(-1)
+
+    def __getitem__(self, index):
+        return CompactQuaternions(self.components[index], self.selectors[index])
+
+    def size(self, dim=None):
+        size = self.selectors.size()
+        return size if dim is None else size[dim]
+
+    @property
+    def shape(self):
+        return self.size()
+
+    def nbytes(self):
+        return self.components.nelement() * self.components.element_size() + self.selectors.nelement()
+
+
+def decode_if_compact(data):
+    return data.decode() if isinstance(data, CompactQuaternions) else data
+
+
+def angular_error_bound():
+    """
+    Worst-case rotation angle (radians) between a unit quaternion and its decoded encoding.
+
+    Each stored component is off by at most half a step, i.e. |dv| <= sqrt(3) * step / 2.
+    The rebuilt component c >= 1/2 changes by |v| * |dv| / c <= sqrt(3) * |dv|, so the
+    quaternion moves at most d = 2 * |dv| on the unit sphere, i.e. a rotation of 4 * asin(d / 2).
+    """
+    distance = 2 * math.sqrt(3) * QUANTIZATION_STEP / 2
+    return 4 * math.asin(distance / 2)
+
+
+def angular_error(q, expected):
+    # Rotation angle (radians) between two sets of unit quaternions, computed in float64
+    return qa.geodesic_angle(q.double(), expected.double())
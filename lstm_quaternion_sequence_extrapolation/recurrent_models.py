@@ -1,52 +1,154 @@
+import time
 import torch
 import torch.nn                         as nn
 import torch.optim
 from torch.autograd                     import Variable
+from torch.utils.checkpoint             import checkpoint
 from core_qnn.quaternion_layers         import *
 from utilities                          import normalize_quaternions
 
-class QALLoss(nn.Module):
-    def __init__(self):
-        super().__init__()
-    
-    def quaternion_conjugate(self, q):
-        w, v = q[:, 0], q[:, 1:]
-        return torch.cat((w.unsqueeze(-1), -v), dim=1)
+class QALLossFunction(torch.autograd.Function):
+    """
+    Quaternion angle loss (2 * acos(w))**2 with w = <output, expected>, the real part of
+    conj(output) * expected, so the Hamilton product is never built. Only w and the
+    inputs needed for the requested gradients are kept for backward, the gradient is
+    the closed form d/dw 4 * acos(w)**2 = -8 * acos(w) / sqrt(1 - w**2), zero where w
+    is clamped to [-1 + epsilon, 1 - epsilon].
+    """
+
+    @staticmethod
+    def forward(ctx, output, expected, reduction='mean', epsilon=1e-4):
+        w = torch.sum(output * expected, dim=-1)
+        # Each input's gradient needs only the other input
+        ctx.save_for_backward(output if ctx.needs_input_grad[1] else None, expected if ctx.needs_input_grad[0] else None, w)
+        ctx.reduction = reduction
+        ctx.epsilon = epsilon
 
-    def quaternion_multiply(self, q1, q2):
-        w1, v1 = q1[:, 0], q1[:, 1:]
-        w2, v2 = q2[:, 0], q2[:, 1:]
+        angles_rad = 2 * torch.acos(torch.clamp(w, -1.0 + epsilon, 1.0 - epsilon))
+        losses = angles_rad * angles_rad
+        if reduction == 'mean':
+            return losses.mean()
+        if reduction == 'sum':
+            return losses.sum()
+        return losses
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        output, expected, w = ctx.saved_tensors
+        grad_output_q = grad_expected = None
+
+        clamped = torch.clamp(w, -1.0 + ctx.epsilon, 1.0 - ctx.epsilon)
+        grad_w = -8 * torch.acos(clamped) * torch.rsqrt(1 - clamped * clamped)
+        grad_w = grad_w.masked_fill_(clamped != w, 0.0) * grad_output
+        if ctx.reduction == 'mean':
+            grad_w = grad_w / w.numel()
+        grad_w = grad_w.unsqueeze(-1)
+
+        if ctx.needs_input_grad[0]:
+            grad_output_q = grad_w * expected
+        if ctx.needs_input_grad[1]:
+            grad_expected = grad_w * output
+        return grad_output_q, grad_expected, None, None
 
-        w = w1 * w2 - (v1 * v2).sum(dim=1)
-        v = w1.unsqueeze(-1) * v2 + w2.unsqueeze(-1) * v1 + torch.cross(v1, v2)
 
-        return torch.cat((w.unsqueeze(-1), v), dim=1)
+class QALLoss(nn.Module):
+    # reduction: 'mean' (default), 'sum' or 'none' for the loss of every sample
+    def __init__(self, reduction='mean'):
+        super().__init__()
+        if reduction not in ('mean', 'sum', 'none'):
+            raise ValueError(f"Unknown reduction: {reduction}")
+        self.reduction = reduction
 
     def forward(self, output: torch.tensor, expected: torch.tensor) -> torch.tensor:
-        distance = self.quaternion_multiply(self.quaternion_conjugate(output), expected)
-        w = distance[:, 0]
-        w.requires_grad_(True)
-
-        epsilon = 1e-4
-        angles_rad = 2 * torch.acos(torch.clamp(w, -1.0 + epsilon, 1.0 - epsilon))
-        angles_rad = angles_rad**2
-        return torch.mean(angles_rad)
+        return QALLossFunction.apply(output, expected, self.reduction)
+
+
+def _recurrent_chunk(layer, x, h, c, W, U, b, project='all'):
+    # Runs layer.cell over x (steps, batch_size, feat_size), returns the projected hidden states of
+    # project='all' steps, of the 'last' step or 'none' (None), and the last (h, c)
+    gates_x = (torch.matmul(x, W) + b).unbind(0)
+    hidden = []
+    for gates in gates_x:
+        h, c = layer.cell(torch.addmm(gates, h, U), c)
+        if project == 'all':
+            hidden.append(h)
+
+    if project == 'all':
+        output = layer.fco(torch.stack(hidden, dim=0))
+    elif project == 'last':
+        output = layer.fco(h.unsqueeze(0))
+    else:
+        output = None
+    return output, h, c
+
+
+def recurrent_forward(layer, x, state=None, last_step_only=False):
+    """
+    QLSTM / VectorizedQLSTM forward over x of shape (seq_len, batch_size, feat_size)
+    starting from state=(h, c), zero state by default. Returns the normalized outputs
+    and the final (h, c).
+
+    With layer.checkpoint_steps set (and grad enabled) the recurrence is checkpointed
+    every K timesteps: each chunk keeps only its input frames, the (h, c) it starts
+    from and its 4-wide outputs for backward. The gate activations are recomputed
+    chunk by chunk during backward, trading about one extra forward for memory
+    linear in seq_len / K + K.
+    """
+    W, U, b = layer.gate_weights()
+    if state is None:
+        h = torch.zeros(x.size(1), layer.hidden_dim, device=x.device, dtype=x.dtype)
+        c = h
+    else:
+        h, c = state
+
+    checkpointing = bool(layer.checkpoint_steps) and torch.is_grad_enabled()
+    chunks = x.split(layer.checkpoint_steps if checkpointing else x.size(0))
+    outputs = []
+    for n, x_chunk in enumerate(chunks):
+        # With last_step_only only the final step of the last chunk is projected
+        project = ('last' if n == len(chunks) - 1 else 'none') if last_step_only else 'all'
+        if checkpointing:
+            output, h, c = checkpoint(_recurrent_chunk, layer, x_chunk, h, c, W, U, b, project, use_reentrant=False)
+        else:
+            output, h, c = _recurrent_chunk(layer, x_chunk, h, c, W, U, b, project)
+        if output is not None:
+            outputs.append(output)
+
+    return normalize_quaternions(torch.cat(outputs, 0), dim=2), (h, c)
+
+
+def stacked_forward_sequence(model, x, states=None):
+    # Shared forward_sequence of StackedQLSTM and VectorizedStackedQLSTM, layers run sequence first
+    if model.batch_first:
+        x = x.transpose(0, 1)
+
+    new_states = []
+    for n, layer in enumerate(model.layers):
+        x, state = recurrent_forward(layer, x, None if states is None else states[n])
+        new_states.append(state)
+
+    if model.batch_first:
+        x = x.transpose(0, 1)
+    return x, new_states
 
 
 class VectorizedStackedQLSTM(nn.Module):
-    def __init__(self, feat_size, hidden_size, n_layers, batch_first, device):
+    def __init__(self, feat_size, hidden_size, n_layers, batch_first, device, last_step_only=True, checkpoint_steps=None):
         super(VectorizedStackedQLSTM, self).__init__()
         
-        self.batch_first =  batch_first
-        self.layers =       nn.ModuleList([VectorizedQLSTM(feat_size, hidden_size, device) for _ in range(n_layers)])
+        # last_step_only: the final layer projects only the timestep that is returned
+        # checkpoint_steps: recompute activations in chunks of that many timesteps during backward
+        self.batch_first =      batch_first
+        self.last_step_only =   last_step_only
+        self.layers =           nn.ModuleList([VectorizedQLSTM(feat_size, hidden_size, device, checkpoint_steps) for _ in range(n_layers)])
 
     def forward(self, x):
         # VectorizedQLSTM takes inputs of shape (batch_size, seq_len, feat_size)
         if not self.batch_first:
             x = x.permute(1,0,2)
 
-        for layer in self.layers:
-            x = layer(x)
+        for n, layer in enumerate(self.layers):
+            x = layer(x, last_step_only=self.last_step_only and n == len(self.layers) - 1)
 
         if not self.batch_first:
             x = x.permute(1,0,2)
@@ -55,18 +157,23 @@ class VectorizedStackedQLSTM(nn.Module):
         x = x[:, -1, :]
         return x
 
+    def forward_sequence(self, x, states=None):
+        # Outputs of every timestep and the final (h, c) of every layer, starting from states (zero state by default)
+        return stacked_forward_sequence(self, x, states)
+
 
 class VectorizedQLSTM(nn.Module):
-    def __init__(self, feat_size, hidden_size, device):
+    def __init__(self, feat_size, hidden_size, device, checkpoint_steps=None):
         super(VectorizedQLSTM, self).__init__()
 
         # Reading options:
-        self.act =          nn.Tanh()
-        self.act_gate =     nn.Sigmoid()
-        self.input_dim =    feat_size
-        self.hidden_dim =   hidden_size
-        self.device =       device
-        self.num_classes =  feat_size
+        self.act =              nn.Tanh()
+        self.act_gate =         nn.Sigmoid()
+        self.input_dim =        feat_size
+        self.hidden_dim =       hidden_size
+        self.device =           device
+        self.num_classes =      feat_size
+        self.checkpoint_steps = checkpoint_steps
 
         self.W = QuaternionLinearAutograd(self.input_dim, 4 * self.hidden_dim)
         self.U = QuaternionLinearAutograd(self.hidden_dim, 4 * self.hidden_dim, bias=False)
@@ -74,54 +181,106 @@ class VectorizedQLSTM(nn.Module):
         # Output layer initialization
         self.fco = nn.Linear(self.hidden_dim, self.num_classes)
 
-    def forward(self, x):
-        batch_size, seq_size, _ = x.size()
-        hidden_size = self.hidden_dim
+        # Column permutation of the expanded W/U, only set on layers converted from QLSTM
+        self.register_buffer('gate_columns', None)
 
-        (h_t, c_t) = (torch.zeros(batch_size, hidden_size).to(self.device), torch.zeros(batch_size, hidden_size).to(self.device))
-        out = []
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Converted QLSTM layers carry their gate_columns in the checkpoint
+        if prefix + 'gate_columns' in state_dict and self.gate_columns is None:
+            self.gate_columns = torch.empty_like(state_dict[prefix + 'gate_columns'])
+        super(VectorizedQLSTM, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-        for t in range(seq_size):
-            x_t = x[:, t, :]
+    def gate_weights(self):
+        # (input_dim, 4 * hidden_dim), (hidden_dim, 4 * hidden_dim) and bias, gates in i/f/g/o order
+        W, U, b = self.W.expanded_weight(), self.U.expanded_weight(), self.W.bias
+        if self.gate_columns is not None:
+            W, U, b = W[:, self.gate_columns], U[:, self.gate_columns], b[self.gate_columns]
+        return W, U, b
 
-            # Feed-forward affine transformations (done in parallel for all gates)
-            gates = self.W(x_t) + self.U(h_t)
+    def cell(self, gates, c_t):
+        # One timestep from the summed gate pre-activations, gates in i/f/g/o order
+        hidden_size = self.hidden_dim
+        i_t, f_t, g_t, o_t = (
+            self.act_gate(gates[:, :hidden_size]),                  # input
+            self.act_gate(gates[:, hidden_size:hidden_size*2]),     # forget
+            self.act(gates[:, hidden_size*2:hidden_size*3]),        # cell
+            self.act_gate(gates[:, hidden_size*3:]),                # output
+        )
 
-            # Splitting the combined gates for each gate type
-            i_t, f_t, g_t, o_t = (
-                self.act_gate(gates[:, :hidden_size]),                  # input
-                self.act_gate(gates[:, hidden_size:hidden_size*2]),     # forget
-                self.act(gates[:, hidden_size*2:hidden_size*3]),        # cell
-                self.act_gate(gates[:, hidden_size*3:]),                # output
-            )
+        c_t = f_t * c_t + i_t * g_t
+        h_t = o_t * self.act(c_t)
+        return h_t, c_t
 
-            c_t = f_t * c_t + i_t * g_t
-            h_t = o_t * self.act(c_t)
+    def forward(self, x, last_step_only=False):
+        if self.checkpoint_steps and torch.is_grad_enabled():
+            return recurrent_forward(self, x.transpose(0, 1), last_step_only=last_step_only)[0].transpose(0, 1)
 
-            output = self.fco(h_t)
-            out.append(output.unsqueeze(0))
+        batch_size, seq_size, _ = x.size()
+        hidden_size = self.hidden_dim
 
-        output = torch.cat(out, dim=0)
-        # reshape from shape (sequence, batch, feature) to (batch, sequence, feature)
-        output = output.transpose(0, 1).contiguous()
+        # Input projection of all timesteps in one GEMM through the low-memory custom autograd function
+        gates_x = quaternion_linear_function(x.transpose(0, 1), self.W.r_weight, self.W.i_weight, self.W.j_weight, self.W.k_weight, self.W.bias)
+        # Recurrent Hamilton matrix built once per forward
+        U = self.U.expanded_weight()
+        if self.gate_columns is not None:
+            gates_x, U = gates_x[..., self.gate_columns], U[:, self.gate_columns]
+        # unbind gives all timesteps one backward node, indexing would scatter into a full-size gradient per step
+        gates_x = gates_x.unbind(0)
+
+        h_t = torch.zeros(batch_size, hidden_size, device=x.device, dtype=x.dtype)
+        c_t = h_t
+
+        # Hidden states go into a preallocated buffer, except under autograd where
+        # in-place writes would copy the whole buffer gradient at every step. Traces
+        # (e.g. SummaryWriter.add_graph) are checked without grad, so they keep one path
+        keep_graph = (torch.is_grad_enabled() and any(p.requires_grad for p in self.parameters())) or torch.jit.is_tracing()
+        if last_step_only:
+            hidden = None
+        elif keep_graph:
+            hidden = []
+        else:
+            hidden = torch.empty(seq_size, batch_size, hidden_size, device=x.device, dtype=x.dtype)
+
+        for t in range(seq_size):
+            # Recurrent affine transformation (done in parallel for all gates)
+            h_t, c_t = self.cell(torch.addmm(gates_x[t], h_t, U), c_t)
+
+            if isinstance(hidden, list):
+                hidden.append(h_t)
+            elif hidden is not None:
+                hidden[t] = h_t
+
+        if last_step_only:
+            # Only the last timestep is projected, output of shape (batch_size, 1, feat_size)
+            hidden = h_t.unsqueeze(0)
+        elif keep_graph:
+            hidden = torch.stack(hidden, dim=0)
+
+        # One projection of all timesteps, from shape (sequence, batch, feature) to (batch, sequence, feature)
+        output = self.fco(hidden.transpose(0, 1))
         output = normalize_quaternions(output, dim=2)
         return output
 
 
 class StackedQLSTM(nn.Module):
-    def __init__(self, feat_size, hidden_size, n_layers, batch_first, device):
+    def __init__(self, feat_size, hidden_size, n_layers, batch_first, device, fused=True, last_step_only=True, checkpoint_steps=None):
         super(StackedQLSTM, self).__init__()
         
-        self.batch_first =  batch_first
-        self.layers =       nn.ModuleList([QLSTM(feat_size, hidden_size, device) for _ in range(n_layers)])
+        # FusedQLSTM keeps the QLSTM parameters, so both load the same checkpoints
+        # last_step_only: the final layer projects only the timestep that is returned
+        # checkpoint_steps: recompute activations in chunks of that many timesteps during backward
+        layer_type =            FusedQLSTM if fused else QLSTM
+        self.batch_first =      batch_first
+        self.last_step_only =   last_step_only
+        self.layers =           nn.ModuleList([layer_type(feat_size, hidden_size, device, checkpoint_steps) for _ in range(n_layers)])
 
     def forward(self, x):
         # QLSTM takes inputs of shape (seq_len, batch_size, feat_size)
         if self.batch_first:
             x = x.permute(1,0,2)
 
-        for layer in self.layers:
-            x = layer(x)
+        for n, layer in enumerate(self.layers):
+            x = layer(x, last_step_only=self.last_step_only and n == len(self.layers) - 1)
 
         if self.batch_first:
             x = x.permute(1,0,2)
@@ -130,18 +289,23 @@ class StackedQLSTM(nn.Module):
         x = x[:, -1, :]
         return x
 
+    def forward_sequence(self, x, states=None):
+        # Outputs of every timestep and the final (h, c) of every layer, starting from states (zero state by default)
+        return stacked_forward_sequence(self, x, states)
+
 
 class QLSTM(nn.Module):
-    def __init__(self, feat_size, hidden_size, device):
+    def __init__(self, feat_size, hidden_size, device, checkpoint_steps=None):
         super(QLSTM, self).__init__()
 
         # Reading options:
-        self.act =          nn.Tanh()
-        self.act_gate =     nn.Sigmoid()
-        self.input_dim =    feat_size
-        self.hidden_dim =   hidden_size
-        self.device =       device
-        self.num_classes =  feat_size
+        self.act =              nn.Tanh()
+        self.act_gate =         nn.Sigmoid()
+        self.input_dim =        feat_size
+        self.hidden_dim =       hidden_size
+        self.device =           device
+        self.num_classes =      feat_size
+        self.checkpoint_steps = checkpoint_steps
 
         # Gates initialization
         self.wfx = QuaternionLinearAutograd(self.input_dim, self.hidden_dim) # Forget
@@ -159,17 +323,42 @@ class QLSTM(nn.Module):
         # Output layer initialization
         self.fco = nn.Linear(self.hidden_dim, self.num_classes)
 
-    def forward(self, x):
+    def gate_weights(self):
+        # (input_dim, 4 * hidden_dim), (hidden_dim, 4 * hidden_dim) and bias, gates in ft/it/ot/at order
+        W = torch.cat([self.wfx.expanded_weight(), self.wix.expanded_weight(), self.wox.expanded_weight(), self.wcx.expanded_weight()], dim=1)
+        U = torch.cat([self.ufh.expanded_weight(), self.uih.expanded_weight(), self.uoh.expanded_weight(), self.uch.expanded_weight()], dim=1)
+        b = torch.cat([self.wfx.bias, self.wix.bias, self.wox.bias, self.wcx.bias])
+        return W, U, b
+
+    def cell(self, gates, c):
+        # One timestep from the summed gate pre-activations, gates in ft/it/ot/at order
+        n_sigmoid = 3 * self.hidden_dim
+        ft, it, ot = self.act_gate(gates[:, :n_sigmoid]).chunk(3, dim=1)
+        at = gates[:, n_sigmoid:]
+
+        c = it * self.act(at) + ft * c
+        h = ot * self.act(c)
+        return h, c
+
+    def forward(self, x, last_step_only=False):
+        if self.checkpoint_steps and torch.is_grad_enabled():
+            return recurrent_forward(self, x.to(self.device), last_step_only=last_step_only)[0]
 
         h_init = Variable(torch.zeros(x.shape[1],self. hidden_dim))
         h_init = h_init.to(self.device)
         x = x.to(self.device)
 
-        # Feed-forward affine transformation (done in parallel)
-        wfx_out = self.wfx(x)
-        wix_out = self.wix(x)
-        wox_out = self.wox(x)
-        wcx_out = self.wcx(x)
+        # Feed-forward affine transformation (done in parallel), one low-memory custom autograd GEMM
+        # per gate over the whole (seq_len, batch_size, feat_size) input, one tensor per timestep
+        wfx_out, wix_out, wox_out, wcx_out = [
+            quaternion_linear_function(x, layer.r_weight, layer.i_weight, layer.j_weight, layer.k_weight, layer.bias).unbind(0)
+            for layer in (self.wfx, self.wix, self.wox, self.wcx)]
+
+        # Recurrent Hamilton matrices built once per forward and reused at every timestep
+        ufh_w = self.ufh.expanded_weight()
+        uih_w = self.uih.expanded_weight()
+        uoh_w = self.uoh.expanded_weight()
+        uch_w = self.uch.expanded_weight()
 
         # Processing time steps
         out = []
@@ -178,22 +367,171 @@ class QLSTM(nn.Module):
 
         for k in range(x.shape[0]):
 
-            ft = self.act_gate(wfx_out[k] + self.ufh(h))
-            it = self.act_gate(wix_out[k] + self.uih(h))
-            ot = self.act_gate(wox_out[k] + self.uoh(h))
+            ft = self.act_gate(wfx_out[k] + torch.mm(h, ufh_w))
+            it = self.act_gate(wix_out[k] + torch.mm(h, uih_w))
+            ot = self.act_gate(wox_out[k] + torch.mm(h, uoh_w))
 
-            at = wcx_out[k] + self.uch(h)
+            at = wcx_out[k] + torch.mm(h, uch_w)
             c = it * self.act(at) + ft * c
             h = ot * self.act(c)
 
-            output = self.fco(h)
-            out.append(output.unsqueeze(0))
+            if not last_step_only:
+                output = self.fco(h)
+                out.append(output.unsqueeze(0))
+
+        if last_step_only:
+            # Only the last timestep is projected, output of shape (1, batch_size, feat_size)
+            out = [self.fco(h).unsqueeze(0)]
 
         output = torch.cat(out,0)
         output = normalize_quaternions(output, dim=2)
         return output
 
 
+class FusedQLSTM(QLSTM):
+    """
+    QLSTM running one input GEMM over the whole sequence and one recurrent GEMM
+    per timestep on the concatenated gate matrices, like VectorizedQLSTM. The
+    parameters are the ones of QLSTM, so QLSTM_*.pth state dicts load unchanged.
+    """
+
+    def forward(self, x, last_step_only=False):
+        x = x.to(self.device)
+        if self.checkpoint_steps and torch.is_grad_enabled():
+            return recurrent_forward(self, x, last_step_only=last_step_only)[0]
+
+        W, U, b = self.gate_weights()
+
+        # Feed-forward affine transformation of all gates and timesteps at once, one tensor per timestep
+        gates_x = (torch.matmul(x, W) + b).unbind(0)
+
+        h = torch.zeros(x.shape[1], self.hidden_dim, device=x.device, dtype=x.dtype)
+        c = h
+        out = []
+
+        for k in range(x.shape[0]):
+            h, c = self.cell(torch.addmm(gates_x[k], h, U), c)
+
+            if not last_step_only:
+                output = self.fco(h)
+                out.append(output.unsqueeze(0))
+
+        if last_step_only:
+            # Only the last timestep is projected, output of shape (1, batch_size, feat_size)
+            out = [self.fco(h).unsqueeze(0)]
+
+        output = torch.cat(out,0)
+        output = normalize_quaternions(output, dim=2)
+        return output
+
+
+def fuse_stacked_qlstm(model: StackedQLSTM):
+    # Converts a (loaded) unfused StackedQLSTM into the fused one with the same weights
+    layer = model.layers[0]
+    fused = StackedQLSTM(layer.input_dim, layer.hidden_dim, len(model.layers), model.batch_first, layer.device, fused=True,
+                         last_step_only=model.last_step_only, checkpoint_steps=layer.checkpoint_steps)
+    fused.load_state_dict(model.state_dict())
+    return fused.to(next(model.parameters()).device)
+
+
+def vectorize_stacked_qlstm(model: StackedQLSTM):
+    """
+    Converts a (loaded) StackedQLSTM into a VectorizedStackedQLSTM computing the same function.
+
+    Output unit u of the vectorized W/U quaternion layers holds unit u % (hidden/4) of
+    QLSTM gate u // (hidden/4), in i/f/g/o order. The expanded matrices then hold every
+    QLSTM gate matrix column for column, gate_columns only permutes them into
+    contiguous gates. The converted layers keep Hamilton structure and can be trained on.
+    """
+    layer = model.layers[0]
+    vectorized = VectorizedStackedQLSTM(layer.input_dim, layer.hidden_dim, len(model.layers), model.batch_first, layer.device,
+                                        last_step_only=model.last_step_only, checkpoint_steps=layer.checkpoint_steps)
+
+    with torch.no_grad():
+        for source, target in zip(model.layers, vectorized.layers):
+            units = source.hidden_dim // 4
+            gates = [(source.wix, source.uih), (source.wfx, source.ufh), (source.wcx, source.uch), (source.wox, source.uoh)]
+
+            for component in ('r_weight', 'i_weight', 'j_weight', 'k_weight'):
+                getattr(target.W, component).copy_(torch.cat([getattr(w, component) for w, _ in gates], dim=1))
+                getattr(target.U, component).copy_(torch.cat([getattr(u, component) for _, u in gates], dim=1))
+            target.W.bias.copy_(torch.stack([w.bias.view(4, units) for w, _ in gates], dim=1).reshape(-1))
+
+            # Expanded column (component c, unit g * units + v) becomes column (gate g, component c, unit v)
+            gate, component, unit = torch.meshgrid(torch.arange(4), torch.arange(4), torch.arange(units), indexing='ij')
+            target.gate_columns = (component * source.hidden_dim + gate * units + unit).reshape(-1)
+            target.fco.load_state_dict(source.fco.state_dict())
+
+    return vectorized.to(next(model.parameters()).device)
+
+
+def convert_qlstm_checkpoint(checkpoint_path: str, output_path: str, batch_first=True):
+    # Writes a VectorizedStackedQLSTM checkpoint computing the same function as a QLSTM_*.pth state dict
+    state_dict = torch.load(checkpoint_path, map_location='cpu')
+    n_layers = len({key.split('.')[1] for key in state_dict if key.startswith('layers.')})
+    input_size, hidden_size = state_dict['layers.0.fco.weight'].shape
+
+    model = StackedQLSTM(input_size, hidden_size, n_layers, batch_first, 'cpu')
+    model.load_state_dict(state_dict)
+    torch.save(vectorize_stacked_qlstm(model).state_dict(), output_path)
+    print(f"Converted {checkpoint_path} -> {output_path}")
+
+
+class LoweredStackedQLSTM(nn.Module):
+    """
+    Inference copy of a StackedQLSTM or VectorizedStackedQLSTM running every layer
+    on the native fused nn.LSTM kernel.
+
+    A QLSTM layer is a standard LSTM whose weight matrices have Hamilton structure,
+    so the expanded matrices are copied into nn.LSTM weights (QLSTM gates reordered
+    from ft/it/ot/at to PyTorch's i/f/g/o, VectorizedQLSTM already uses it). The
+    per-step fco projection and normalization between layers are kept. The copy is
+    detached from the source model's parameters.
+    """
+
+    def __init__(self, model: nn.Module):
+        super(LoweredStackedQLSTM, self).__init__()
+
+        self.batch_first =  model.batch_first
+        self.lstms =        nn.ModuleList()
+        self.projections =  nn.ModuleList()
+
+        with torch.no_grad():
+            for layer in model.layers:
+                W, U, b = layer.gate_weights()
+                order = torch.arange(4 * layer.hidden_dim)
+                if isinstance(layer, QLSTM):
+                    ft, it, ot, at = range(4)
+                    order = torch.cat([torch.arange(gate * layer.hidden_dim, (gate + 1) * layer.hidden_dim) for gate in (it, ft, at, ot)])
+
+                lstm = nn.LSTM(layer.input_dim, layer.hidden_dim, 1, batch_first=True)
+                lstm.weight_ih_l0.copy_(W[:, order].t())
+                lstm.weight_hh_l0.copy_(U[:, order].t())
+                lstm.bias_ih_l0.copy_(b[order])
+                lstm.bias_hh_l0.zero_()
+
+                projection = nn.Linear(layer.hidden_dim, layer.num_classes)
+                projection.load_state_dict(layer.fco.state_dict())
+
+                self.lstms.append(lstm)
+                self.projections.append(projection)
+
+        self.to(next(model.parameters()).device)
+
+    def forward(self, x):
+        # nn.LSTM layers run batch first: (batch_size, seq_len, feat_size)
+        if not self.batch_first:
+            x = x.permute(1,0,2)
+
+        for lstm, projection in zip(self.lstms, self.projections):
+            x, _ = lstm(x)
+            x = normalize_quaternions(projection(x), dim=2)
+
+        # Sentiment classification!
+        x = x[:, -1, :]
+        return x
+
+
 class LSTM(nn.Module):
     def __init__(self, input_size, hidden_size, num_layers, num_classes, device):
         super(LSTM, self).__init__()
@@ -212,4 +550,61 @@ class LSTM(nn.Module):
         out = out[:, -1, :]                 # out: [Sentiment classification!]
         out = self.fc(out)
         out = normalize_quaternions(out, dim=1)
-        return out
\ No newline at end of file
+        return out
+
+    def forward_sequence(self, x, states=None):
+        # Outputs of every timestep and the final (h, c), starting from states (zero state by default)
+        out, states = self.lstm(x, states)
+        return normalize_quaternions(self.fc(out), dim=2), states
+
+
+class EagerFallback(nn.Module):
+    """
+    Runs the compiled model and switches to the eager model for good when a later
+    call fails to compile, e.g. a recompile for an input shape the warm-up did not see.
+    """
+
+    def __init__(self, model: nn.Module, compiled: nn.Module):
+        super(EagerFallback, self).__init__()
+        self.model =        model
+        self.compiled =     compiled
+
+    def forward(self, *args):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args)
+            except Exception as ex:
+                print(f"Compilation failed, using eager model: {type(ex).__name__}: {ex}")
+                self.compiled = None
+        return self.model(*args)
+
+
+def compile_model(model: nn.Module, example_input: torch.tensor, backward=False):
+    """
+    Returns model wrapped with torch.compile, or model itself when compilation fails.
+
+    torch.compile compiles lazily on the first call, so the warm-up call on example_input
+    happens here and compilation errors fall back to eager execution. With backward=True
+    the warm-up also compiles the backward graph (training). The batch dimension is marked
+    dynamic, so a smaller last batch reuses the warm-up graph, and later compilation
+    failures fall back through EagerFallback. Keep using model itself for state_dict,
+    the compiled wrapper shares its parameters.
+    """
+    start_time = time.perf_counter()
+    try:
+        compiled = torch.compile(model)
+        torch._dynamo.maybe_mark_dynamic(example_input, 0)
+        if backward:
+            compiled(example_input).sum().backward()
+            model.zero_grad()
+        else:
+            with torch.no_grad():
+                compiled(example_input)
+    except Exception as ex:
+        print(f"Compilation failed, using eager model: {type(ex).__name__}: {ex}")
+        model.zero_grad()
+        return model
+
+    print(f"Compilation warm-up: {(time.perf_counter() - start_time):.2f}s")
+    return EagerFallback(model, compiled)
+
@@ -5,8 +5,10 @@ import numpy as np
 from torch.utils.data import DataLoader, random_split
 
 import recurrent_models as rm
-from dataset_initializer import RotationDataset
+from dataset_initializer import RotationDataset, IndexBatchLoader
+from dataset_shards import ShardedRotationDataset
 from utilities import *
+from quaternion_encoding import angular_error
 
 def saved_evaluation(
         input_size = 4,             # Quaternion
@@ -22,8 +24,11 @@ def saved_evaluation(
         model_type = ModelType.LSTM,
         is_qal_loss = False,
         show_evaluation = False,
+        index_batching = True,
+        use_compile = False,
         calculate_accuracy = True,
         max_acc_round_point = 7,
+        per_recording = False,
 
         model_dir = rf"./models",
         set_name = "hip",
@@ -61,7 +66,11 @@ def saved_evaluation(
 
     # 1. Creating dataset
     print("1. Creating dataset")
-    dataset = RotationDataset(training_path, labels_path, input_size, sequence_length)
+    if os.path.isdir(training_path):
+        # Sharded binary set written by dataset_shards.convert_to_shards
+        dataset = ShardedRotationDataset(training_path, sequence_length)
+    else:
+        dataset = RotationDataset(training_path, labels_path, input_size, sequence_length)
 
 
     # 2. Splitting dataset
@@ -73,8 +82,12 @@ def saved_evaluation(
 
     # 3. Generating DataLoaders
     print("3. Generating DataLoaders")
-    train_loader = DataLoader(dataset=training_dataset, batch_size=batch_size)
-    test_loader = DataLoader(dataset=test_dataset, batch_size=batch_size)
+    if index_batching:
+        train_loader = IndexBatchLoader(training_dataset, batch_size=batch_size)
+        test_loader = IndexBatchLoader(test_dataset, batch_size=batch_size)
+    else:
+        train_loader = DataLoader(dataset=training_dataset, batch_size=batch_size)
+        test_loader = DataLoader(dataset=test_dataset, batch_size=batch_size)
 
 
     # 4. Creating model
@@ -102,6 +115,12 @@ def saved_evaluation(
         return
     print("State data load completed")
 
+    # Compiled forward, the eager model keeps the state dict
+    forward_model = model
+    if use_compile:
+        print("Compiling model")
+        forward_model = rm.compile_model(model, next(iter(test_loader))[0].to(device))
+
 
     # 5. Criterion
     print("\n5. Creating criterion")
@@ -124,14 +143,20 @@ def saved_evaluation(
         test_loss = []
         correct_predictions = [0 for _ in range(max_acc_round_point + 1)]
         n_samples = 0
+        sample_errors = []
+        sample_losses = []
+        sample_criterion = rm.QALLoss(reduction='none')
 
         for (rotations, labels) in test_loader:
             rotations = rotations.to(device)
             labels = labels.to(device)
             labels = labels.reshape(labels.shape[0], input_size)
-            output = model(rotations)
+            output = forward_model(rotations)
 
             test_loss.append(criterion_eval(output, labels).item())
+            if per_recording:
+                sample_errors.append(angular_error(output, labels).cpu())
+                sample_losses.append(sample_criterion(output, labels).cpu())
 
             # Calculating accuracy
             output = output.tolist()
@@ -164,6 +189,18 @@ def saved_evaluation(
             for i in range(len(correct_predictions)):
                 print(f'accuracy [{i}]: {((100 * correct_predictions[i]) / (input_size * batch_size * n_samples)):.2f}')
 
+        # Per recording breakdown from the row label index
+        if per_recording and hasattr(dataset, "sample_metadata"):
+            recordings = dataset.sample_metadata(test_dataset.indices)["recording"]
+            sample_errors = np.degrees(torch.cat(sample_errors).numpy())
+            sample_losses = torch.cat(sample_losses).numpy()
+            print("\nPER RECORDING")
+            for recording in np.unique(recordings):
+                errors = sample_errors[recordings == recording]
+                losses = sample_losses[recordings == recording]
+                print(f'[{recording}] samples: {len(errors)}, angle error mean: {np.mean(errors):.5f} deg, std: {np.std(errors):.5f} deg, '
+                      f'QAL mean: {np.mean(losses):.7f}')
+
 
 
 if __name__ == "__main__":
@@ -187,6 +224,7 @@ if __name__ == "__main__":
     show_evaluation = False
     calculate_accuracy = True
     max_acc_round_point = 7
+    per_recording = False
 
     set_name = "neck"
     model_dir = rf"./models"
@@ -208,6 +246,7 @@ if __name__ == "__main__":
             show_evaluation = show_evaluation,
             calculate_accuracy = calculate_accuracy,
             max_acc_round_point = max_acc_round_point,
+            per_recording = per_recording,
 
             model_dir = model_dir,
             set_name = set_name,
@@ -218,4 +257,7 @@ if __name__ == "__main__":
     execute_saved_evaluation(ModelType.LSTM, False)        # LSTM MSE
     execute_saved_evaluation(ModelType.LSTM, True)         # LSTM QAL
     execute_saved_evaluation(ModelType.QLSTM, False)       # QLSTM MSE
-    execute_saved_evaluation(ModelType.QLSTM, True)        # QLSTM QAL
\ No newline at end of file
+    execute_saved_evaluation(ModelType.QLSTM, True)        # QLSTM QAL
+    # VectorizedQLSTM checkpoints are written by training.py or rm.convert_qlstm_checkpoint, none ship in models/
+    # execute_saved_evaluation(ModelType.VectorizedQLSTM, False)     # Vectorized QLSTM MSE
+    # execute_saved_evaluation(ModelType.VectorizedQLSTM, True)      # Vectorized QLSTM QAL
\ No newline at end of file
@@ -0,0 +1,196 @@
+import torch
+import torch.nn as nn
+from typing import List
+
+import recurrent_models as rm
+from core_qnn.quaternion_ops import quaternion_linear_kernel
+from core_qnn import quaternion_algebra as qa
+
+
+class ScriptQuaternionLinear(nn.Module):
+    """
+    TorchScript-compatible QuaternionLinearAutograd (rotation=False). Parameter
+    names match the original layer, so its state dict loads unchanged.
+    """
+
+    def __init__(self, in_features, out_features, bias=True):
+        super(ScriptQuaternionLinear, self).__init__()
+
+        self.in_features =  in_features // 4
+        self.out_features = out_features // 4
+        self.r_weight =     nn.Parameter(torch.zeros(self.in_features, self.out_features))
+        self.i_weight =     nn.Parameter(torch.zeros(self.in_features, self.out_features))
+        self.j_weight =     nn.Parameter(torch.zeros(self.in_features, self.out_features))
+        self.k_weight =     nn.Parameter(torch.zeros(self.in_features, self.out_features))
+        self.bias =         nn.Parameter(torch.zeros(self.out_features * 4)) if bias else None
+
+    @torch.jit.export
+    def expanded_weight(self) -> torch.Tensor:
+        return quaternion_linear_kernel(self.r_weight, self.i_weight, self.j_weight, self.k_weight)
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        output = torch.matmul(input, self.expanded_weight())
+        bias = self.bias
+        if bias is not None:
+            output = output + bias
+        return output
+
+
+class ScriptQLSTM(nn.Module):
+    # TorchScript-compatible QLSTM layer, inputs of shape (seq_len, batch_size, feat_size)
+
+    def __init__(self, feat_size: int, hidden_size: int):
+        super(ScriptQLSTM, self).__init__()
+
+        self.input_dim =    feat_size
+        self.hidden_dim =   hidden_size
+        self.num_classes =  feat_size
+
+        self.wfx = ScriptQuaternionLinear(self.input_dim, self.hidden_dim) # Forget
+        self.ufh = ScriptQuaternionLinear(self.hidden_dim, self.hidden_dim, bias=False) # Forget
+        self.wix = ScriptQuaternionLinear(self.input_dim, self.hidden_dim) # Input
+        self.uih = ScriptQuaternionLinear(self.hidden_dim, self.hidden_dim, bias=False) # Input
+        self.wox = ScriptQuaternionLinear(self.input_dim, self.hidden_dim) # Output
+        self.uoh = ScriptQuaternionLinear(self.hidden_dim, self.hidden_dim, bias=False) # Output
+        self.wcx = ScriptQuaternionLinear(self.input_dim, self.hidden_dim) # Cell
+        self.uch = ScriptQuaternionLinear(self.hidden_dim, self.hidden_dim, bias=False) # Cell
+
+        self.fco = nn.Linear(self.hidden_dim, self.num_classes)
+
+    def forward(self, x: torch.Tensor, last_step_only: bool = False) -> torch.Tensor:
+        # Gate matrices concatenated in ft/it/ot/at order, as in FusedQLSTM
+        W = torch.cat([self.wfx.expanded_weight(), self.wix.expanded_weight(), self.wox.expanded_weight(), self.wcx.expanded_weight()], dim=1)
+        U = torch.cat([self.ufh.expanded_weight(), self.uih.expanded_weight(), self.uoh.expanded_weight(), self.uch.expanded_weight()], dim=1)
+        gates_x = torch.matmul(x, W) + torch.cat([self.wfx.bias, self.wix.bias, self.wox.bias, self.wcx.bias])
+
+        h = torch.zeros(x.size(1), self.hidden_dim, device=x.device, dtype=x.dtype)
+        c = h
+        out: List[torch.Tensor] = []
+        n_sigmoid = 3 * self.hidden_dim
+
+        for k in range(x.size(0)):
+            gates = torch.addmm(gates_x[k], h, U)
+            sigmoid_gates = torch.sigmoid(gates[:, :n_sigmoid]).chunk(3, dim=1)
+            ft, it, ot = sigmoid_gates[0], sigmoid_gates[1], sigmoid_gates[2]
+            at = gates[:, n_sigmoid:]
+
+            c = it * torch.tanh(at) + ft * c
+            h = ot * torch.tanh(c)
+            if not last_step_only:
+                out.append(self.fco(h))
+
+        if last_step_only:
+            out = [self.fco(h)]
+
+        return qa.normalize(torch.stack(out, 0), dim=2)
+
+
+class ScriptVectorizedQLSTM(nn.Module):
+    # TorchScript-compatible VectorizedQLSTM layer, inputs of shape (batch_size, seq_len, feat_size)
+
+    def __init__(self, feat_size: int, hidden_size: int):
+        super(ScriptVectorizedQLSTM, self).__init__()
+
+        self.input_dim =    feat_size
+        self.hidden_dim =   hidden_size
+        self.num_classes =  feat_size
+
+        self.W = ScriptQuaternionLinear(self.input_dim, 4 * self.hidden_dim)
+        self.U = ScriptQuaternionLinear(self.hidden_dim, 4 * self.hidden_dim, bias=False)
+
+        self.fco = nn.Linear(self.hidden_dim, self.num_classes)
+
+        # Identity unless the layer was converted from QLSTM, see rm.vectorize_stacked_qlstm
+        self.register_buffer('gate_columns', torch.arange(4 * self.hidden_dim))
+
+    def forward(self, x: torch.Tensor, last_step_only: bool = False) -> torch.Tensor:
+        hidden_size = self.hidden_dim
+        U = self.U.expanded_weight()[:, self.gate_columns]
+        gates_x = torch.matmul(x, self.W.expanded_weight()[:, self.gate_columns]) + self.W.bias[self.gate_columns]
+
+        h_t = torch.zeros(x.size(0), hidden_size, device=x.device, dtype=x.dtype)
+        c_t = h_t
+        out: List[torch.Tensor] = []
+
+        for t in range(x.size(1)):
+            gates = gates_x[:, t, :] + torch.mm(h_t, U)
+
+            i_t = torch.sigmoid(gates[:, :hidden_size])
+            f_t = torch.sigmoid(gates[:, hidden_size:hidden_size*2])
+            g_t = torch.tanh(gates[:, hidden_size*2:hidden_size*3])
+            o_t = torch.sigmoid(gates[:, hidden_size*3:])
+
+            c_t = f_t * c_t + i_t * g_t
+            h_t = o_t * torch.tanh(c_t)
+            if not last_step_only:
+                out.append(self.fco(h_t))
+
+        if last_step_only:
+            out = [self.fco(h_t)]
+
+        return qa.normalize(torch.stack(out, 1), dim=2)
+
+
+class ScriptStackedQLSTM(nn.Module):
+    """
+    TorchScript-compatible StackedQLSTM / VectorizedStackedQLSTM. vectorized selects
+    the layer type, state dicts of the matching training model load unchanged.
+    """
+
+    def __init__(self, feat_size: int, hidden_size: int, n_layers: int, batch_first: bool, vectorized=False):
+        super(ScriptStackedQLSTM, self).__init__()
+
+        layer_type =        ScriptVectorizedQLSTM if vectorized else ScriptQLSTM
+        self.batch_first =  batch_first
+        self.vectorized =   vectorized
+        self.layers =       nn.ModuleList([layer_type(feat_size, hidden_size) for _ in range(n_layers)])
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # Layers run batch first when vectorized, sequence first otherwise
+        if self.batch_first != self.vectorized:
+            x = x.permute(1,0,2)
+
+        n_layers = len(self.layers)
+        for n, layer in enumerate(self.layers):
+            x = layer(x, last_step_only=(n == n_layers - 1))
+
+        if self.batch_first != self.vectorized:
+            x = x.permute(1,0,2)
+
+        # Sentiment classification!
+        return x[:, -1, :]
+
+
+def script_model(model: nn.Module):
+    """
+    Returns the TorchScript module of a (trained) StackedQLSTM or VectorizedStackedQLSTM,
+    carrying the model's weights on the model's device.
+    """
+    if not isinstance(model, (rm.StackedQLSTM, rm.VectorizedStackedQLSTM)):
+        raise TypeError(f"Scripting supports StackedQLSTM and VectorizedStackedQLSTM, got {type(model).__name__}")
+
+    layer = model.layers[0]
+    vectorized = isinstance(model, rm.VectorizedStackedQLSTM)
+    scriptable = ScriptStackedQLSTM(layer.input_dim, layer.hidden_dim, len(model.layers), model.batch_first, vectorized)
+    state_dict = model.state_dict()
+    if vectorized:
+        for n, source in enumerate(model.layers):
+            if source.gate_columns is None:
+                state_dict[f"layers.{n}.gate_columns"] = scriptable.layers[n].gate_columns
+    scriptable.load_state_dict(state_dict)
+    scriptable.to(next(model.parameters()).device)
+    return torch.jit.script(scriptable.eval())
+
+
+def save_scripted_model(model: nn.Module, file_path: str):
+    # The saved file loads with torch.jit.load alone, no import of this repository is needed
+    scripted = script_model(model)
+    torch.jit.save(scripted, file_path)
+    print(f"Scripted model saved: {file_path}")
+    return scripted
+
+
+if __name__ == "__main__":
+    model = rm.StackedQLSTM(4, 128, 2, batch_first=True, device='cpu')
+    model.load_state_dict(torch.load(r"./models/QLSTM_qal_hip_epochs25.pth", map_location='cpu'))
+    save_scripted_model(model, r"./models/QLSTM_qal_hip_epochs25_scripted.pt")
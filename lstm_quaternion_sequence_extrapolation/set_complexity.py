@@ -1,47 +1,140 @@
 import csv
+from itertools import islice
+import numpy as np
 import torch
 
 file_path = r"./data/mockup/source_sets.csv"
 
-def calculate_set_complexity(data:torch.tensor, label:str):
-    # Coefficient of variation
-    mean = torch.mean(data + 1)
-    std = torch.std(data + 1)
-    cv = (std / mean) * 100
-    print(f'[{label}] Coefficient of variation: {cv.item()}%')
-
-    # Interquartile range
-    iqr = torch.quantile(data, 0.75) - torch.quantile(data, 0.25)
-    print(f'[{label}] Interquartile range: {iqr.item()}')
-
-    # Entropy
-    hist = torch.histc(data, bins=10, min=float(data.min()), max=float(data.max()))
-    pdf = hist / torch.sum(hist)
-    entropy = -torch.sum(pdf * torch.log2(pdf + torch.finfo(torch.float32).eps))
-    print(f'[{label}] Entropy: {entropy.item()}')
-
-    return [label, cv.item(), iqr.item(), entropy.item()]
-
-csv_data = []
-with open(file_path, 'r') as file:
-    reader = csv.reader(file)
-    for row in reader:
-        csv_data.append(row)
-
-labels = csv_data[0]
-data = csv_data[1:]
-for i in range(len(data)):
-    for j in range(len(data[0])):
-        data[i][j] = float(data[i][j])
-
-data = torch.tensor(data)
-data = data.transpose(0, 1)
-
-result_list = [["Name", "Coefficient of variation", "Interquartile range", "Entropy"]]
-for i in range(len(labels)):
-    result_list.append(calculate_set_complexity(data=data[i], label=labels[i]))
-
-with open("set_complexity_result.csv", 'w', newline="") as file:
-    writer = csv.writer(file)
-    for data in result_list:
-        writer.writerow(data)
\ No newline at end of file
+class QuantileSketch:
+    """
+    Mergeable quantile sketch over many columns at once.
+
+    Items live in levels, an item of level l stands for 2^l input values. A level
+    reaching capacity items is sorted and every second item (random offset) is
+    promoted to the next level. Every column receives the same number of values,
+    so all columns compact together and each level is a single (columns, items)
+    tensor. Until the first compaction the sketch is exact.
+    """
+
+    def __init__(self, n_columns, capacity=4096, generator=None):
+        self.n_columns =    n_columns
+        self.capacity =     capacity
+        self.generator =    generator
+        self.levels =       [torch.empty(n_columns, 0)]
+
+    def update(self, values):
+        # values: (columns, n)
+        self._append(0, values)
+
+    def merge(self, other):
+        for level, values in enumerate(other.levels):
+            self._append(level, values)
+
+    def _append(self, level, values):
+        while len(self.levels) <= level:
+            self.levels.append(torch.empty(self.n_columns, 0))
+        self.levels[level] = torch.cat([self.levels[level], values], dim=1)
+
+        if self.levels[level].size(1) >= self.capacity:
+            items = torch.sort(self.levels[level], dim=1).values
+            n_paired = (items.size(1) // 2) * 2
+            offset = int(torch.randint(2, (1,), generator=self.generator))
+            self.levels[level] = items[:, n_paired:]
+            self._append(level + 1, items[:, offset:n_paired:2])
+
+    def is_exact(self):
+        return all(values.size(1) == 0 for values in self.levels[1:])
+
+    def items(self):
+        # (columns, items) values with their (items,) weights
+        values = torch.cat(self.levels, dim=1)
+        weights = torch.cat([torch.full((values.size(1),), 2.0**level) for level, values in enumerate(self.levels)])
+        return values, weights
+
+    def quantile(self, q):
+        if self.is_exact():
+            return torch.quantile(self.levels[0], q, dim=1)
+
+        values, weights = self.items()
+        values, order = torch.sort(values, dim=1)
+        cumulative = torch.cumsum(weights[order], dim=1)
+        rank = torch.searchsorted(cumulative, torch.full((self.n_columns, 1), q * float(weights.sum())))
+        return torch.gather(values, 1, rank.clamp(max=values.size(1) - 1)).squeeze(1)
+
+    def histogram(self, minimum, maximum, bins):
+        # Weighted histogram over [minimum, maximum] per column, exact while the sketch is exact
+        values, weights = self.items()
+        width = (maximum - minimum).clamp(min=torch.finfo(torch.float32).tiny).unsqueeze(1)
+        bin_ids = ((values - minimum.unsqueeze(1)) * bins / width).long().clamp(0, bins - 1)
+        hist = torch.zeros(self.n_columns, bins, dtype=torch.float64)
+        return hist.scatter_add_(1, bin_ids, weights.double().expand_as(values).contiguous())
+
+
+def streaming_set_complexity(file_path:str, chunk_rows=65536, sketch_capacity=4096, bins=10, seed=303):
+    """
+    Single-pass set complexity of every column of a source set CSV in bounded memory.
+
+    Coefficient of variation comes from merged float64 moments, the interquartile
+    range from a QuantileSketch and the entropy from a histogram of the sketch over
+    the exact column range. All columns are processed together per chunk. Results
+    equal the in-memory reference (see dataset_benchmark.legacy_set_complexity) while the set fits the sketch capacity.
+    """
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+
+    with open(file_path, 'r') as file:
+        labels = next(csv.reader([file.readline()]))
+        n_columns = len(labels)
+
+        count = 0
+        mean = torch.zeros(n_columns, dtype=torch.float64)
+        m2 = torch.zeros(n_columns, dtype=torch.float64)
+        minimum = torch.full((n_columns,), float('inf'))
+        maximum = torch.full((n_columns,), float('-inf'))
+        sketch = QuantileSketch(n_columns, sketch_capacity, generator)
+
+        while True:
+            rows = list(islice(file, chunk_rows))
+            if not rows:
+                break
+            chunk = torch.from_numpy(np.loadtxt(rows, dtype=np.float32, delimiter=',', ndmin=2)).t()
+
+            # Chan et al. merge of (count, mean, M2), shifted by 1 as in the in-memory reference
+            shifted = chunk.double() + 1
+            chunk_count = chunk.size(1)
+            chunk_mean = shifted.mean(dim=1)
+            chunk_m2 = ((shifted - chunk_mean.unsqueeze(1)) ** 2).sum(dim=1)
+            delta = chunk_mean - mean
+            total = count + chunk_count
+            mean = mean + delta * chunk_count / total
+            m2 = m2 + chunk_m2 + delta**2 * count * chunk_count / total
+            count = total
+
+            minimum = torch.minimum(minimum, chunk.min(dim=1).values)
+            maximum = torch.maximum(maximum, chunk.max(dim=1).values)
+            sketch.update(chunk)
+
+    cv = torch.sqrt(m2 / (count - 1)) / mean * 100
+    iqr = sketch.quantile(0.75) - sketch.quantile(0.25)
+    hist = sketch.histogram(minimum, maximum, bins)
+    pdf = hist / hist.sum(dim=1, keepdim=True)
+    entropy = -torch.sum(pdf * torch.log2(pdf + torch.finfo(torch.float32).eps), dim=1)
+
+    result_list = [["Name", "Coefficient of variation", "Interquartile range", "Entropy"]]
+    for i, label in enumerate(labels):
+        print(f'[{label}] Coefficient of variation: {cv[i].item()}%')
+        print(f'[{label}] Interquartile range: {iqr[i].item()}')
+        print(f'[{label}] Entropy: {entropy[i].item()}')
+        result_list.append([label, cv[i].item(), iqr[i].item(), entropy[i].item()])
+    return result_list
+
+
+def save_set_complexity(result_list, output_path="set_complexity_result.csv"):
+    with open(output_path, 'w', newline="") as file:
+        writer = csv.writer(file)
+        for data in result_list:
+            writer.writerow(data)
+
+
+if __name__ == "__main__":
+    save_set_complexity(streaming_set_complexity(file_path))
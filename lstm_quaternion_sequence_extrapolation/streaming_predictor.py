@@ -0,0 +1,134 @@
+import copy
+import torch
+import torch.nn as nn
+
+import recurrent_models as rm
+from utilities import normalize_quaternions
+
+
+def recurrent_stages(model: nn.Module):
+    """
+    Returns the model as a list of (nn.LSTM, projection) stages, each stage output
+    being projected and normalized. The stages are a snapshot of the model weights,
+    quaternion models are lowered through LoweredStackedQLSTM and LSTM layers copied.
+    """
+    with torch.no_grad():
+        if isinstance(model, rm.LSTM):
+            # One multi-layer nn.LSTM, projected once at the end
+            return [(copy.deepcopy(model.lstm), copy.deepcopy(model.fc))]
+        if isinstance(model, (rm.StackedQLSTM, rm.VectorizedStackedQLSTM)):
+            lowered = rm.LoweredStackedQLSTM(model)
+            return list(zip(lowered.lstms, lowered.projections))
+    raise TypeError(f"Stateful prediction supports LSTM, StackedQLSTM and VectorizedStackedQLSTM, got {type(model).__name__}")
+
+
+def run_stages(stages, x, states=None):
+    # x: (batch_size, seq_len, feat_size), returns the last stage output and the new states
+    new_states = []
+    for n, (lstm, projection) in enumerate(stages):
+        x, state = lstm(x, None if states is None else states[n])
+        new_states.append(state)
+        x = normalize_quaternions(projection(x), dim=2)
+    return x, new_states
+
+
+def rollout(model: nn.Module, sequences: torch.tensor, n_frames: int):
+    """
+    Extrapolates n_frames future rotations of a batch of sequences, shape
+    (batch_size, seq_len, 4) -> (batch_size, n_frames, 4).
+
+    The sequences are encoded once, then every prediction is fed back as the next
+    input while the recurrent state is carried forward, so each future frame costs
+    a single step. This equals re-running the growing sequence (history plus
+    predictions) from zero state, not re-feeding a fixed-length sliding window.
+    """
+    stages = recurrent_stages(model)
+    device = next(model.parameters()).device
+
+    with torch.no_grad():
+        x, states = run_stages(stages, sequences.to(device))
+        prediction = x[:, -1, :]
+
+        output = torch.empty(sequences.size(0), n_frames, prediction.size(1), device=device)
+        for n in range(n_frames):
+            output[:, n] = prediction
+            x, states = run_stages(stages, prediction.unsqueeze(1), states)
+            prediction = x[:, 0, :]
+    return output
+
+
+class StreamingPredictor:
+    """
+    Frame-by-frame next rotation prediction for many live streams at once.
+
+    The (h, c) state of every layer is kept per stream, so each call consumes one
+    new frame per stream at O(1) cost instead of re-running the whole window.
+    Streams are identified by any hashable id and batched together in a single call.
+    A new id starts from zero state like a window does, reset() restarts a stream
+    and evict() frees its slot. The predictor is a snapshot of the model weights at
+    construction time, see recurrent_stages.
+    """
+
+    def __init__(self, model: nn.Module, capacity=16):
+        stages = recurrent_stages(model)
+
+        self.stages =       stages
+        self.device =       next(model.parameters()).device
+        self.capacity =     capacity
+        self.slots =        {}
+        self.free_slots =   list(range(capacity - 1, -1, -1))
+        self.states =       [(torch.zeros(lstm.num_layers, capacity, lstm.hidden_size, device=self.device),
+                              torch.zeros(lstm.num_layers, capacity, lstm.hidden_size, device=self.device)) for lstm, _ in stages]
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, stream_id):
+        return stream_id in self.slots
+
+    def _grow(self):
+        # Doubles the state storage, new slots start from zero state
+        added = self.capacity
+        self.states = [(torch.cat([h, torch.zeros_like(h)], dim=1), torch.cat([c, torch.zeros_like(c)], dim=1)) for h, c in self.states]
+        self.free_slots = list(range(self.capacity + added - 1, self.capacity - 1, -1)) + self.free_slots
+        self.capacity += added
+
+    def _slot(self, stream_id):
+        if stream_id not in self.slots:
+            if not self.free_slots:
+                self._grow()
+            self.slots[stream_id] = self.free_slots.pop()
+        return self.slots[stream_id]
+
+    def step(self, stream_ids, frames: torch.tensor):
+        """
+        Consumes one frame per stream, frames of shape (len(stream_ids), 4), and returns
+        the predicted next rotation of every stream, shape (len(stream_ids), 4).
+        """
+        if len(set(stream_ids)) != len(stream_ids):
+            raise ValueError("Every stream can consume only one frame per step")
+
+        slots = torch.tensor([self._slot(stream_id) for stream_id in stream_ids], device=self.device)
+        x = frames.to(self.device).reshape(len(stream_ids), 1, -1)
+
+        with torch.no_grad():
+            for (lstm, projection), (h, c) in zip(self.stages, self.states):
+                x, (h_t, c_t) = lstm(x, (h[:, slots], c[:, slots]))
+                h[:, slots] = h_t
+                c[:, slots] = c_t
+                x = normalize_quaternions(projection(x), dim=2)
+        return x[:, 0, :]
+
+    def reset(self, stream_ids):
+        # Restarts the streams from zero state, keeping their slots
+        slots = [self.slots[stream_id] for stream_id in stream_ids if stream_id in self.slots]
+        for h, c in self.states:
+            h[:, slots] = 0
+            c[:, slots] = 0
+
+    def evict(self, stream_ids):
+        # Drops the streams and frees their slots
+        self.reset(stream_ids)
+        for stream_id in stream_ids:
+            if stream_id in self.slots:
+                self.free_slots.append(self.slots.pop(stream_id))
@@ -0,0 +1,119 @@
+import io
+import os
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from core_qnn import quaternion_algebra as qa
+from dataset_windows import SlidingWindowDataset
+from dataset_shards import write_shards
+
+
+def _rotation_vector_to_quaternion(v):
+    # Rotation by |v| radians about v, exp of the pure quaternion v / 2
+    return qa.exp(F.pad(v / 2, (1, 0)))
+
+
+def _slerp(q1, q2, t):
+    # q1, q2: (..., 4), t: (frames,) -> (..., frames, 4)
+    # Keyframes are sign-continuous, so this is the shortest arc
+    dot = (q1 * q2).sum(dim=-1, keepdim=True).clamp(-1.0, 1.0).unsqueeze(-2)
+    theta = torch.acos(dot)
+    sin_theta = torch.sin(theta)
+    t = t.view(-1, 1)
+    linear = sin_theta < 1e-6
+    s1 = torch.where(linear, 1 - t, torch.sin((1 - t) * theta) / sin_theta.clamp(min=1e-12))
+    s2 = torch.where(linear, t, torch.sin(t * theta) / sin_theta.clamp(min=1e-12))
+    return s1 * q1.unsqueeze(-2) + s2 * q2.unsqueeze(-2)
+
+
+def generate_rotation_tracks(n_recordings=8, n_joints=3, n_frames=2000, keyframe_interval=20,
+                             angular_velocity_std=0.05, angular_damping=0.9, noise_std=0.002, seed=303):
+    """
+    Generates smooth continuous joint rotations of shape (recordings, joints, frames, 4).
+
+    Keyframes follow a damped random walk of the angular velocity (radians per keyframe),
+    frames between keyframes are SLERP-interpolated, and small Gaussian noise is added
+    before renormalizing. Tracks are sign-continuous, like the mocap recordings.
+    """
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    n_keyframes = math.ceil((n_frames - 1) / keyframe_interval) + 1
+
+    start = _rotation_vector_to_quaternion(0.5 * torch.randn(n_recordings, n_joints, 3, generator=generator, dtype=torch.float64))
+    keyframes = [start]
+    velocity = torch.zeros(n_recordings, n_joints, 3, dtype=torch.float64)
+    for _ in range(n_keyframes - 1):
+        velocity = angular_damping * velocity + angular_velocity_std * torch.randn(velocity.shape, generator=generator, dtype=torch.float64)
+        keyframes.append(qa.multiply(keyframes[-1], _rotation_vector_to_quaternion(velocity)))
+        # Stay in the hemisphere of the previous keyframe, the track never jumps between q and -q
+        continuity = (keyframes[-1] * keyframes[-2]).sum(dim=-1, keepdim=True)
+        keyframes[-1] = torch.where(continuity < 0, -keyframes[-1], keyframes[-1])
+
+    t = torch.arange(keyframe_interval, dtype=torch.float64) / keyframe_interval
+    segments = [_slerp(keyframes[k], keyframes[k + 1], t) for k in range(n_keyframes - 1)]
+    tracks = torch.cat(segments + [keyframes[-1].unsqueeze(-2)], dim=-2)[..., :n_frames, :]
+
+    tracks = tracks + noise_std * torch.randn(tracks.shape, generator=generator, dtype=torch.float64)
+    return qa.normalize(tracks)
+
+
+def _window_labels(recording, joint, start, sequence_length):
+    return [f'"{recording} - {joint} [{component}] ({start},{start + sequence_length - 1})"' for component in "wijk"]
+
+
+def write_rotation_csvs(tracks, training_path, labels_path, sequence_length=100, stride=1, horizon=1,
+                        recording_prefix="Synth", joint_names=None, chunk_windows=4096):
+    """
+    Writes tracks from generate_rotation_tracks as windowed training/labels CSVs in the
+    layout of the mockup sets: four rows (w, i, j, k) per sample, each starting with a
+    label like "Synth0003 - Joint1Angles [w] (0,99)".
+    """
+    n_recordings, n_joints = tracks.shape[:2]
+    if joint_names is None:
+        joint_names = [f"Joint{joint}Angles" for joint in range(n_joints)]
+
+    with open(training_path, 'w') as training_file, open(labels_path, 'w') as labels_file:
+        for recording in range(n_recordings):
+            for joint in range(n_joints):
+                windows = SlidingWindowDataset(tracks[recording, joint], sequence_length, stride, horizon)
+                for first in range(0, len(windows), chunk_windows):
+                    indices = torch.arange(first, min(first + chunk_windows, len(windows)))
+                    rotations, labels = windows.get_batch(indices)
+
+                    row_labels = []
+                    for index in indices.tolist():
+                        row_labels += _window_labels(f"{recording_prefix}{recording:04d}", joint_names[joint], index * stride, sequence_length)
+
+                    for file, values in ((training_file, rotations), (labels_file, labels)):
+                        # (windows, frames, 4) -> one row per component
+                        rows = io.StringIO()
+                        np.savetxt(rows, values.transpose(1, 2).reshape(-1, values.size(1)).numpy(), fmt='%.16g', delimiter=',')
+                        file.writelines(f"{label},{row}\n" for label, row in zip(row_labels, rows.getvalue().splitlines()))
+
+
+def write_rotation_shards(tracks, output_dir, sequence_length=100, stride=1, horizon=1, samples_per_shard=4096):
+    # Same windows as write_rotation_csvs, written straight to the sharded binary format
+    windows = SlidingWindowDataset([track.float() for track in tracks.reshape(-1, *tracks.shape[2:])], sequence_length, stride, horizon)
+    batches = (windows.get_batch(torch.arange(first, min(first + samples_per_shard, len(windows))))
+               for first in range(0, len(windows), samples_per_shard))
+    return write_shards(batches, output_dir, tracks.size(-1), sequence_length, samples_per_shard)
+
+
+def generate_synthetic_set(output_dir, n_recordings=8, n_joints=3, n_frames=2000, sequence_length=100, stride=10,
+                           seed=303, name="synthetic", shards=False):
+    # Generates a windowed CSV pair (and optionally shards) in output_dir, returns the CSV paths
+    os.makedirs(output_dir, exist_ok=True)
+    training_path = os.path.join(output_dir, f"training_data_{name}.csv")
+    labels_path = os.path.join(output_dir, f"labels_data_{name}.csv")
+
+    tracks = generate_rotation_tracks(n_recordings, n_joints, n_frames, seed=seed)
+    write_rotation_csvs(tracks, training_path, labels_path, sequence_length, stride)
+    if shards:
+        write_rotation_shards(tracks, os.path.join(output_dir, f"shards_{name}"), sequence_length, stride)
+    return training_path, labels_path
+
+
+if __name__ == "__main__":
+    generate_synthetic_set(r"./data/mockup/large", n_recordings=8, n_joints=3, n_frames=2000, sequence_length=100, stride=10, shards=True)
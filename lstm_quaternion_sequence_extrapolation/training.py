@@ -1,3 +1,4 @@
+import os
 import time
 import torch
 import torch.nn as nn
@@ -6,10 +7,42 @@ from torch.utils.data import DataLoader, random_split
 from torch.utils.tensorboard import SummaryWriter
 
 import recurrent_models as rm
-from dataset_initializer import RotationDataset
+from dataset_initializer import RotationDataset, IndexBatchLoader, RecordingTrackLoader
+from dataset_shards import ShardedRotationDataset
 from utilities import seconds_to_hms, generate_model_file_name, ModelType
 
 
+def window_outputs(model, train_loader, device):
+    # Model outputs and labels of independent windows, every window starts from zero state
+    for rotations, labels in train_loader:
+        yield model(rotations.to(device)), labels.to(device).reshape(labels.shape[0], 4)
+
+
+def detach_states(states):
+    # Cuts the graph behind (nested) recurrent states, keeping their values
+    if isinstance(states, torch.Tensor):
+        return states.detach()
+    return type(states)(detach_states(state) for state in states)
+
+
+def stateful_outputs(model, train_loader, sequence_length, device):
+    """
+    Truncated-BPTT over the tracks of a RecordingTrackLoader. Every track batch is cut
+    into chunks of sequence_length frames and the detached (h, c) states of one chunk
+    start the next, so each frame is encoded once per epoch. Yields the outputs and
+    labels at the labelled frames of every chunk, the caller steps the optimizer
+    before the next chunk runs.
+    """
+    for rotations, labels, mask in train_loader:
+        states = None
+        for chunk in zip(rotations.split(sequence_length, dim=1), labels.split(sequence_length, dim=1), mask.split(sequence_length, dim=1)):
+            chunk_rotations, chunk_labels, chunk_mask = (part.to(device) for part in chunk)
+            outputs, states = model.forward_sequence(chunk_rotations, states)
+            states = detach_states(states)
+            if chunk_mask.any():
+                yield outputs[chunk_mask], chunk_labels[chunk_mask]
+
+
 def training(
         input_size = 4,             # Quaternion
         sequence_length = 100,      # Frames
@@ -25,12 +58,19 @@ def training(
         model_type = ModelType.LSTM,
         is_qal_loss = True, 
         show_evaluation = False, 
+        index_batching = True,
+        use_compile = False,
+        stateful = False,
 
         model_dir = rf"./models",
         set_name = "hip",
         training_path = r"./data/mockup/large/training_data.csv",
         labels_path = r"./data/mockup/large/labels_data.csv"
 ):
+    if stateful and os.path.isdir(training_path):
+        # Tracks are rebuilt from the row labels, shards keep only the sample tensors
+        raise ValueError(f"Stateful training needs the CSV set with row labels, sharded sets are not supported: {training_path}")
+
     # Random seed configuration
     torch.manual_seed(303)
 
@@ -62,7 +102,11 @@ def training(
 
     # 1. Creating dataset
     print("\n1. Creating dataset")
-    dataset = RotationDataset(training_path, labels_path, input_size, sequence_length)
+    if os.path.isdir(training_path):
+        # Sharded binary set written by dataset_shards.convert_to_shards
+        dataset = ShardedRotationDataset(training_path, sequence_length)
+    else:
+        dataset = RotationDataset(training_path, labels_path, input_size, sequence_length)
 
 
     # 2. Splitting dataset
@@ -74,8 +118,16 @@ def training(
 
     # 3. Generating DataLoaders
     print("3. Generating DataLoaders")
-    train_loader = DataLoader(dataset=training_dataset, batch_size=batch_size)
-    test_loader = DataLoader(dataset=test_dataset, batch_size=batch_size)
+    if index_batching:
+        train_loader = IndexBatchLoader(training_dataset, batch_size=batch_size)
+        test_loader = IndexBatchLoader(test_dataset, batch_size=batch_size)
+    else:
+        train_loader = DataLoader(dataset=training_dataset, batch_size=batch_size)
+        test_loader = DataLoader(dataset=test_dataset, batch_size=batch_size)
+    if stateful:
+        # Training windows merged into recording tracks, batch_size tracks per batch
+        train_loader = RecordingTrackLoader(training_dataset, batch_size=batch_size)
+        print(f"Stateful training: {train_loader.n_windows} windows, {train_loader.n_frames} frames in {train_loader.n_tracks} tracks")
     examples = iter(test_loader)
     example_data, example_targets = next(examples)
 
@@ -98,6 +150,13 @@ def training(
         print("Incorrect model type!")
         return
 
+    # Compiled forward, the eager model keeps the state dict
+    # Stateful training runs the eager forward_sequence, the compiled forward serves evaluation
+    forward_model = model
+    if use_compile:
+        print("Compiling model")
+        forward_model = rm.compile_model(model, example_data.to(device), backward=not stateful)
+
     print(f"Sequence length: {sequence_length}")
     print(f"Layers: {num_layers}")
     print(f"Hidden size: {hidden_size}")
@@ -127,19 +186,22 @@ def training(
 
     # 6. Training loop
     print("\n6. Starting training loop")
-    n_total_steps = len(train_loader)
+    n_total_steps = train_loader.n_chunks(sequence_length) if stateful else len(train_loader)
     running_loss = 0.0
     start_time = time.time()
 
     model.train()
     for epoch in range(num_epochs):
-        for i, (rotations, labels) in enumerate(train_loader):
-            rotations = rotations.to(device)
-            labels = labels.to(device)
-            labels = labels.reshape(labels.shape[0], 4)
-
-            # Forward
-            outputs = model(rotations)
+        # Streaming datasets reseed their shuffle from the epoch
+        if hasattr(getattr(train_loader, 'dataset', None), 'set_epoch'):
+            train_loader.dataset.set_epoch(epoch)
+        if stateful:
+            batches = stateful_outputs(model, train_loader, sequence_length, device)
+        else:
+            batches = window_outputs(forward_model, train_loader, device)
+
+        # Forward
+        for i, (outputs, labels) in enumerate(batches):
             loss = criterion(outputs, labels)
             
             # Backward
@@ -174,7 +236,7 @@ def training(
             rotations = rotations.to(device)
             labels = labels.to(device)
             labels = labels.reshape(labels.shape[0], input_size)
-            output = model(rotations)
+            output = forward_model(rotations)
 
             test_loss.append(criterion_eval(output, labels).item())
 
@@ -252,5 +314,5 @@ if __name__ == "__main__":
     execute_training(True, ModelType.LSTM)              # LSTM QAL
     execute_training(False, ModelType.QLSTM)            # QLSTM MSE
     execute_training(True, ModelType.QLSTM)             # QLSTM QAL
-    # execute_training(False, ModelType.VectorizedQLSTM)  # Vectorized QLSTM MSE
-    # execute_training(True, ModelType.VectorizedQLSTM)   # Vectorized QLSTM QAL 
\ No newline at end of file
+    execute_training(False, ModelType.VectorizedQLSTM)  # Vectorized QLSTM MSE
+    execute_training(True, ModelType.VectorizedQLSTM)   # Vectorized QLSTM QAL 
\ No newline at end of file
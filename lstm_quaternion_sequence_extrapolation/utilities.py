@@ -1,9 +1,9 @@
-import torch
 from enum import Enum
 
+from core_qnn import quaternion_algebra as qa
+
 def normalize_quaternions(q, dim):
-        norms = torch.norm(q, dim=dim, keepdim=True)
-        return q / norms
+        return qa.normalize(q, dim)
 
 def seconds_to_hms(seconds):
     hours = seconds // 3600